@@ -1,5 +1,15 @@
+import argparse
 import collections
+import collections.abc
+import functools
+import itertools
+import multiprocessing
+import os
+import zlib
 import numpy as np
+import scipy.sparse
+import scipy.special
+import pipeline
 import util
 import svm
 
@@ -23,7 +33,31 @@ def get_words(message):
     # *** END CODE HERE ***
 
 
-def create_dictionary(messages):
+def iter_chunks(iterable, chunk_size):
+    """Yield successive lists of at most chunk_size items from an iterable."""
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, chunk_size))
+
+
+def count_document_frequency(messages):
+    """Count the number of messages each word appears in.
+
+    Args:
+        messages: An iterable of strings containing SMS messages
+
+    Returns:
+        A collections.Counter mapping words to message counts.
+    """
+    dict_msgcount = collections.Counter()
+    for line in messages:
+        dict_msgcount.update(set(get_words(line)))
+    return dict_msgcount
+
+
+def create_dictionary(messages, n_jobs=1, chunk_size=10000):
     """Create a dictionary mapping words to integer indices.
 
     This function should create a dictionary of word to indices using the provided
@@ -32,72 +66,186 @@ def create_dictionary(messages):
     Rare words are often not useful for modeling. Please only add words to the dictionary
     if they occur in at least five messages.
 
+    Messages are consumed as a stream. With n_jobs > 1, chunks of chunk_size
+    messages are counted in a process pool and the partial counters merged.
+
     Args:
-        messages: A list of strings containing SMS messages
+        messages: An iterable of strings containing SMS messages
+        n_jobs: Number of processes used to count document frequencies
+        chunk_size: Number of messages sent to a process at a time
 
     Returns:
         A python dict mapping words to integers.
     """
 
     # *** START CODE HERE ***
-    dict_msgcount = {}
-    dict_common = {}
     msg_threshold = 5
 
-    #track number of different messages the word appeared in with dict_msgcount 
-    for line in messages:
-        # get a list of (unique) words from message line
-        line_list = np.unique(get_words(line))
-        
-        # for every unique word in line list
-        for word in line_list:
-            if word in dict_msgcount:
-                dict_msgcount[word] += 1
-            else:
-                dict_msgcount[word] = 1
-    
-    #create a dict that contains words that have appeared in at least 5 messages
-    word_idx = 0
-    for key in sorted(dict_msgcount.keys()): #make this alphabetical, because that's the convention
-        if (dict_msgcount[key] >= msg_threshold):
-            dict_common[key] = word_idx
-            word_idx+=1    
-    
-    return dict_common
+    #track number of different messages the word appeared in with dict_msgcount
+    if n_jobs > 1:
+        dict_msgcount = collections.Counter()
+        with multiprocessing.Pool(n_jobs) as pool:
+            for partial in pool.imap_unordered(count_document_frequency,
+                                               iter_chunks(messages, chunk_size)):
+                dict_msgcount.update(partial)
+    else:
+        dict_msgcount = count_document_frequency(messages)
+
+    #keep words that have appeared in at least 5 messages, alphabetical because that's the convention
+    common = sorted(word for word, count in dict_msgcount.items() if count >= msg_threshold)
+    return {word: word_idx for word_idx, word in enumerate(common)}
     # *** END CODE HERE ***
 
 
 def transform_text(messages, word_dictionary):
-    """Transform a list of text messages into a numpy array for further processing.
+    """Transform a list of text messages into a sparse matrix for further processing.
 
-    This function should create a numpy array that contains the number of times each word
-    appears in each message. Each row in the resulting array should correspond to each 
+    This function should create a matrix that contains the number of times each word
+    appears in each message. Each row in the resulting matrix should correspond to each 
     message and each column should correspond to a word.
 
     Use the provided word dictionary to map words to column indices. Ignore words that 
     are not present in the dictionary. Use get_words to get the words for a message.
 
+    The (row, column) pairs of every word occurrence are collected in a single
+    pass and summed into a CSR matrix of int32 counts.
+
     Args:
-        messages: A list of strings where each string is an SMS message.
+        messages: An iterable of strings where each string is an SMS message.
         word_dictionary: A python dict mapping words to integers.
 
     Returns:
-        A numpy array marking the words present in each message.
+        A scipy.sparse CSR matrix marking the words present in each message.
     """
     # *** START CODE HERE ***
-    text_array = np.zeros((len(messages),len(word_dictionary)))
+    rows = []
+    cols = []
 
     row_idx = 0
     for line in messages:
-        line_list = get_words(line)
-        for word in line_list:
-            if word in word_dictionary:
-                col_idx = word_dictionary[word]
-                text_array[row_idx,col_idx]+=1
+        for word in get_words(line):
+            col_idx = word_dictionary.get(word)
+            if col_idx is not None:
+                rows.append(row_idx)
+                cols.append(col_idx)
         row_idx += 1
-    return text_array
+
+    counts = np.ones(len(rows), dtype=np.int32)
+    text_matrix = scipy.sparse.coo_matrix((counts, (rows, cols)),
+                                          shape=(row_idx, len(word_dictionary)))
+    return text_matrix.tocsr()
     # *** END CODE HERE ***
 
+def hash_text(messages, num_bits=18, signed=True, n_jobs=1, chunk_size=10000):
+    """Transform text messages into hashed word counts, without a dictionary.
+
+    Each word is mapped to one of 2^num_bits columns by the low bits of its
+    CRC32 hash, which is stable across processes and runs. With signed=True
+    the top bit of the hash picks a +1 or -1 increment, so that collisions
+    cancel out in expectation for linear models and the SVM; use
+    signed=False for naive Bayes, which needs non-negative counts. The exact
+    kernel SVM works on bit-packed rows whose width grows with 2^num_bits, so
+    a smaller num_bits (around 13) keeps it fast.
+
+    Args:
+        messages: An iterable of strings where each string is an SMS message.
+        num_bits: Number of bits of the hash used as column index (at most 31).
+        signed: Whether to use the hash to sign the counts.
+        n_jobs: Number of processes hashing chunks of messages in parallel.
+        chunk_size: Number of messages sent to a process at a time.
+
+    Returns:
+        A scipy.sparse CSR matrix of shape (number of messages, 2^num_bits).
+    """
+    if n_jobs > 1:
+        hash_chunk = functools.partial(hash_text, num_bits=num_bits, signed=signed)
+        with multiprocessing.Pool(n_jobs) as pool:
+            chunks = pool.map(hash_chunk, iter_chunks(messages, chunk_size))
+        if not chunks:
+            return scipy.sparse.csr_matrix((0, 2 ** num_bits), dtype=np.int32)
+        return scipy.sparse.vstack(chunks, format='csr')
+
+    mask = 2 ** num_bits - 1
+    rows = []
+    cols = []
+    counts = []
+
+    row_idx = 0
+    for line in messages:
+        for word in get_words(line):
+            word_hash = zlib.crc32(word.encode('utf8'))
+            rows.append(row_idx)
+            cols.append(word_hash & mask)
+            counts.append(-1 if signed and word_hash >> 31 else 1)
+        row_idx += 1
+
+    hashed_matrix = scipy.sparse.coo_matrix((np.array(counts, dtype=np.int32), (rows, cols)),
+                                            shape=(row_idx, mask + 1)).tocsr()
+    hashed_matrix.eliminate_zeros()
+    return hashed_matrix
+
+
+_shard_features = None
+
+
+def _init_shard_worker(word_dictionary, num_bits, signed):
+    global _shard_features
+    if word_dictionary is not None:
+        _shard_features = functools.partial(transform_text, word_dictionary=word_dictionary)
+    else:
+        _shard_features = functools.partial(hash_text, num_bits=num_bits, signed=signed)
+
+
+def _load_shard(tsv_path, start, end):
+    labels = []
+
+    def messages():
+        for message, label in util.iter_spam_tsv(tsv_path, start, end):
+            labels.append(label)
+            yield message
+
+    matrix = _shard_features(messages())
+    return matrix, np.array(labels, dtype=np.int64)
+
+
+def load_spam_features(tsv_path, word_dictionary=None, num_bits=18, n_jobs=None,
+                       shard_size=64 * 1024 ** 2, signed=True):
+    """Tokenize and vectorize a spam TSV file in parallel.
+
+    The file is split into byte ranges of about shard_size that hold whole
+    lines, and each shard is parsed and vectorized by a process of the pool,
+    streaming its messages into a CSR matrix without keeping them around.
+    The shard matrices are stacked in file order.
+
+    Args:
+        tsv_path: Path to TSV file containing dataset.
+        word_dictionary: A python dict or Vocabulary mapping words to integers.
+            If None, the features are hashed with hash_text instead.
+        num_bits: Number of hash bits when word_dictionary is None.
+        n_jobs: Number of processes (default: number of CPUs).
+        shard_size: Approximate number of bytes per shard.
+        signed: Whether hashed counts are signed (see hash_text); pass
+            signed=False for naive Bayes, which needs non-negative counts.
+
+    Returns:
+        A scipy.sparse CSR matrix of word counts, and the array of labels.
+    """
+    shards = util.spam_tsv_shards(tsv_path, shard_size)
+    n_cols = len(word_dictionary) if word_dictionary is not None else 2 ** num_bits
+    if not shards:
+        return scipy.sparse.csr_matrix((0, n_cols), dtype=np.int32), np.zeros(0, dtype=np.int64)
+
+    if n_jobs == 1 or len(shards) == 1:
+        _init_shard_worker(word_dictionary, num_bits, signed)
+        results = [_load_shard(tsv_path, start, end) for start, end in shards]
+    else:
+        with multiprocessing.Pool(n_jobs, _init_shard_worker, (word_dictionary, num_bits, signed)) as pool:
+            results = pool.starmap(_load_shard, [(tsv_path, start, end) for start, end in shards])
+
+    matrices, labels = zip(*results)
+    return scipy.sparse.vstack(matrices, format='csr'), np.concatenate(labels)
+
+
 def compute_best_svm_radius(train_matrix, train_labels, val_matrix, val_labels, radius_to_consider):
     """Compute the optimal SVM radius using the provided training and evaluation datasets.
 
@@ -115,38 +263,143 @@ def compute_best_svm_radius(train_matrix, train_labels, val_matrix, val_labels,
         The best radius which maximizes SVM accuracy.
     """
     # *** START CODE HERE ***
+    radius_accuracies = svm_radius_accuracies(train_matrix, train_labels, val_matrix, val_labels, radius_to_consider)
+    return best_svm_radius(radius_accuracies)
+    # *** END CODE HERE ***
+
+
+def svm_radius_accuracies(train_matrix, train_labels, val_matrix, val_labels, radius_to_consider):
+    """Return [radius, accuracy] pairs, evaluating all radii from one shared distance computation."""
+    predictions = svm.svm_radius_sweep(train_matrix, train_labels, val_matrix, radius_to_consider)
+    return [[radius, accuracy(predict,val_labels)] for radius, predict in zip(radius_to_consider, predictions)]
+
+
+def best_svm_radius(radius_accuracies):
+    """Return the first radius with the best accuracy among [radius, accuracy] pairs."""
     best_radius = 0
     best_accuracy = 0
-
-    # iterate through list of radii, return radius with best accuracy
-    for radius in radius_to_consider:
-        predict = svm.train_and_predict_svm(train_matrix, train_labels, val_matrix, radius)
-        if accuracy(predict,val_labels) > best_accuracy:
+    for radius, radius_accuracy in radius_accuracies:
+        if radius_accuracy > best_accuracy:
             best_radius = radius
-            best_accuracy = accuracy(predict,val_labels)
+            best_accuracy = radius_accuracy
     return best_radius
-    # *** END CODE HERE ***
 
 
-def main():
-    # Load datasets
-    train_messages, train_labels = util.load_spam_dataset('../data/ds6_train.tsv')
-    val_messages, val_labels = util.load_spam_dataset('../data/ds6_val.tsv')
-    test_messages, test_labels = util.load_spam_dataset('../data/ds6_test.tsv')
-    
-    # a1. create dictionary
-    dictionary = create_dictionary(train_messages)
-    util.write_json('./output/p06_dictionary', dictionary)
+def save_features(features, path):
+    """Save a (CSR matrix, labels) pair in a single .npz file."""
+    matrix, labels = features
+    np.savez(path, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+             shape=matrix.shape, labels=labels)
+
+
+def load_features(path):
+    """Load a (CSR matrix, labels) pair written by save_features."""
+    with np.load(path) as data:
+        matrix = scipy.sparse.csr_matrix((data['data'], data['indices'], data['indptr']),
+                                         shape=tuple(data['shape']))
+        return matrix, data['labels']
+
+
+# Stages of the spam pipeline, see build_pipeline
+
+def _dictionary_stage(tsv_path):
+    return create_dictionary(message for message, _ in util.iter_spam_tsv(tsv_path))
+
+
+def _features_stage(dictionary, tsv_path):
+    return load_spam_features(tsv_path, dictionary)
+
+
+def _naive_bayes_stage(train_features):
+    return naive_bayes().fit(*train_features)
+
+
+def _svm_sweep_stage(train_features, val_features, radii):
+    return svm_radius_accuracies(train_features[0], train_features[1],
+                                 val_features[0], val_features[1], radii)
+
+
+def _svm_stage(train_features, radius_accuracies, seed):
+    radius = best_svm_radius(radius_accuracies)
+    return svm.svm_train(train_features[0], train_features[1], radius,
+                         rng=np.random.RandomState(seed)), radius
 
-    # a2. create NB multinomial event model feature matrices
-    train_matrix = transform_text(train_messages, dictionary)
-    val_matrix = transform_text(val_messages, dictionary)
-    test_matrix = transform_text(test_messages, dictionary)
-    np.savetxt('./output/p06_sample_train_matrix', train_matrix[:100,:])
+
+def build_pipeline(train_path, val_path, test_path, cache_dir, radii=(0.01, 0.1, 1, 10), seed=123):
+    """Build the spam workflow as a cached stage graph.
+
+    The stages are the dictionary, the train/val/test feature matrices, the
+    naive Bayes model, the SVM radius sweep and the final SVM. Their results
+    are cached in cache_dir under a hash of their inputs and of the functions
+    they call (the whole svm module for the SVM stages), so for instance
+    changing the radii or svm.py only re-runs the sweep and the final SVM.
+
+    Args:
+        train_path: Path to the training TSV file.
+        val_path: Path to the validation TSV file.
+        test_path: Path to the test TSV file.
+        cache_dir: Directory holding the cached artifacts.
+        radii: The SVM radii to sweep.
+        seed: Seed of the random state used to train the final SVM.
+
+    Returns:
+        A pipeline.Pipeline.
+    """
+    features_format = ('.npz', save_features, load_features)
+    naive_bayes_format = ('.npz', lambda clf, path: clf.save(path), naive_bayes.load)
+    svm_format = ('.npz', lambda model, path: svm.save_model(path, *model), svm.load_model)
+
+    # The code each stage calls, hashed into its cache key
+    dictionary_code = (create_dictionary, count_document_frequency, iter_chunks, get_words,
+                       util.iter_spam_tsv)
+    features_code = (load_spam_features, _init_shard_worker, _load_shard, transform_text,
+                     hash_text, iter_chunks, get_words, util.spam_tsv_shards, util.iter_spam_tsv)
+
+    spam_pipeline = pipeline.Pipeline(cache_dir)
+    spam_pipeline.add('dictionary', _dictionary_stage, files={'tsv_path': train_path}, fmt='json',
+                      code=dictionary_code)
+    spam_pipeline.add('train_features', _features_stage, ['dictionary'],
+                      files={'tsv_path': train_path}, fmt=features_format, code=features_code)
+    spam_pipeline.add('val_features', _features_stage, ['dictionary'],
+                      files={'tsv_path': val_path}, fmt=features_format, code=features_code)
+    spam_pipeline.add('test_features', _features_stage, ['dictionary'],
+                      files={'tsv_path': test_path}, fmt=features_format, code=features_code)
+    spam_pipeline.add('naive_bayes', _naive_bayes_stage, ['train_features'], fmt=naive_bayes_format,
+                      code=[naive_bayes])
+    spam_pipeline.add('svm_sweep', _svm_sweep_stage, ['train_features', 'val_features'],
+                      params={'radii': list(radii)}, fmt='json',
+                      code=[svm_radius_accuracies, accuracy, svm])
+    spam_pipeline.add('svm', _svm_stage, ['train_features', 'svm_sweep'],
+                      params={'seed': seed}, fmt=svm_format, code=[best_svm_radius, svm])
+    return spam_pipeline
+
+
+def main(args):
+    spam_pipeline = build_pipeline(args.train_path, args.val_path, args.test_path, args.cache_dir,
+                                   args.radii, args.seed)
+    results = spam_pipeline.run()
+
+    def export(path, stage, write):
+        # only rewrite outputs whose stage was recomputed
+        if stage in spam_pipeline.computed or not os.path.exists(path):
+            write(path)
+
+    # a1. create dictionary, streaming the training messages
+    dictionary = results['dictionary']
+    vocabulary = Vocabulary.from_dict(dictionary)
+    export('./output/p06_dictionary', 'dictionary', lambda path: util.write_json(path, dictionary))
+    export('./output/p06_vocabulary', 'dictionary', vocabulary.save)
+
+    # a2. load datasets as NB multinomial event model feature matrices
+    train_matrix, train_labels = results['train_features']
+    val_matrix, val_labels = results['val_features']
+    test_matrix, test_labels = results['test_features']
+    export('./output/p06_sample_train_matrix', 'train_features',
+           lambda path: np.savetxt(path, train_matrix[:100,:].toarray()))
 
     # b1. create a naive bayes classifier, fit it with training matrix and labels
-    clf = naive_bayes()
-    clf.fit(train_matrix,train_labels)
+    clf = results['naive_bayes']
+    export('./output/p06_naive_bayes.npz', 'naive_bayes', clf.save)
 
     # b2. return predictions of spam or not spam with trained classifier
     predict_val = clf.predict(val_matrix)
@@ -155,81 +408,233 @@ def main():
     print('test accuracy:',accuracy(predict_test,test_labels))
 
     # c. get top 5 words indicative of spam
-    clf.top5words(dictionary)
+    clf.top5words(vocabulary)
 
-    # d. train an svm with an rbf kernel
-    optimal_radius = compute_best_svm_radius(train_matrix, train_labels, val_matrix, val_labels, [0.01, 0.1, 1, 10])
-    svm_predictions = svm.train_and_predict_svm(train_matrix, train_labels, test_matrix, optimal_radius)
+    # d. train an svm with an rbf kernel, using the radius with the best validation accuracy
+    svm_model, optimal_radius = results['svm']
+    export('./output/p06_svm.npz', 'svm', lambda path: svm.save_model(path, svm_model, optimal_radius))
+    svm_predictions = svm.svm_predict(svm_model, test_matrix, optimal_radius)
     svm_accuracy = np.mean(svm_predictions == test_labels)
     print('The optimal SVM radius was {}'.format(optimal_radius))
     print('The SVM model had an accuracy of {} on the testing set'.format(svm_accuracy, optimal_radius))
 
 class naive_bayes(object):
-    def __init__(self, py0=None,py1=None,phi0=0,phi1=0):
-        self.py0 = py0
-        self.py1 = py1
-        self.phi0 = phi0
-        self.phi1 = phi1
-    
+    """Multinomial naive Bayes kept as per-class count accumulators.
+
+    The model only stores the number of messages and the total count of each
+    word for both labels, so it can be updated with new messages through
+    partial_fit, and models trained on separate shards can be combined with
+    merge. The priors and Laplace-smoothed word probabilities are derived
+    from the counts when needed.
+    """
+    def __init__(self):
+        self.class_counts = None # (2,) number of messages with label 0 and 1
+        self.word_counts = None  # (2, n) count of each word in messages with label 0 and 1
+
     def fit(self, matrix,labels):
-        
-        # Priors: P(Y=1),P(Y=0)
-        self.py1 = sum(labels)/len(labels)
-        self.py0 = 1-self.py1
-    
-        # MLE estimators, P(xj=k|Y=1) with Laplace Smoothing
+        self.class_counts = None
+        self.word_counts = None
+        return self.partial_fit(matrix,labels)
+
+    def partial_fit(self, matrix, labels):
         n = matrix.shape[1] #number of indexed words in dict & feature matrix
-        x_y1 = matrix[labels==1]
-        x_y0 = matrix[labels==0]
-
-        # xj|Y prob = (# of xj words in Y=1) / (# of words in Y=1)
-        # Laplace smoothing: [(# of xj words in Y=1)+1] / [(# of words in Y=1)+n]
-        self.phi1 = (sum(x_y1,0)+1)/(sum(x_y1.flatten())+n)
-        self.phi0 =(sum(x_y0,0)+1)/(sum(x_y0.flatten())+n)
-        assert(self.phi1.shape == (n,))
-        assert(self.phi0.shape == (n,))
-    
+        if self.word_counts is None:
+            self.class_counts = np.zeros(2)
+            self.word_counts = np.zeros((2,n))
+        assert(self.word_counts.shape == (2,n))
+
+        for k in (0,1):
+            x_yk = matrix[labels==k]
+            self.class_counts[k] += x_yk.shape[0]
+            self.word_counts[k] += np.asarray(x_yk.sum(axis=0)).ravel()
+        return self
+
+    def merge(self, other):
+        # an unfitted model adds nothing, and merging into one copies the other's counts,
+        # so shards can be reduced into a fresh naive_bayes()
+        if other.word_counts is None:
+            return self
+        if self.word_counts is None:
+            self.class_counts = np.array(other.class_counts, dtype=float)
+            self.word_counts = np.array(other.word_counts, dtype=float)
+            return self
+        assert(self.word_counts.shape == other.word_counts.shape)
+        self.class_counts += other.class_counts
+        self.word_counts += other.word_counts
+        return self
+
+    # Priors: P(Y=1),P(Y=0)
+    @property
+    def py1(self):
+        return self.class_counts[1]/self.class_counts.sum()
+
+    @property
+    def py0(self):
+        return self.class_counts[0]/self.class_counts.sum()
+
+    # MLE estimators, P(xj=k|Y) with Laplace Smoothing
+    # xj|Y prob = (# of xj words in Y) / (# of words in Y)
+    # Laplace smoothing: [(# of xj words in Y)+1] / [(# of words in Y)+n]
+    @property
+    def phi1(self):
+        return (self.word_counts[1]+1)/(self.word_counts[1].sum()+self.word_counts.shape[1])
+
+    @property
+    def phi0(self):
+        return (self.word_counts[0]+1)/(self.word_counts[0].sum()+self.word_counts.shape[1])
+
+    def predict_log_proba(self, matrix):
+        m = matrix.shape[0]
+
+        # log(p(x|y=k)p(y=k)) for both labels, never leaving log space
+        log_phi = np.log(np.stack([self.phi0,self.phi1],axis=1))
+        log_joint = matrix@log_phi + np.log(self.class_counts/self.class_counts.sum())
+        assert(log_joint.shape == (m,2))
+
+        # normalize with Bayes Rule, using log-sum-exp for the evidence
+        return log_joint - scipy.special.logsumexp(log_joint,axis=1,keepdims=True)
+
     def predict(self, matrix):
-        m = len(matrix)
-        
-        # calculate log(p(x|y=k)),l_pxyk, to prevent underflow and for efficiency
-        l_pxy0 = matrix@np.log(self.phi0)
-        l_pxy1 = matrix@np.log(self.phi1)
-
-        # extract p(x|y=1) by taking exp of log
-        pxy0 = np.exp(l_pxy0)
-        pxy1 = np.exp(l_pxy1)
-        assert (pxy0.shape == (m,))
-        assert(pxy1.shape == (m,))
-
-        # calculate naive bayes classifier probabilities, with Bayes Rule
-        probs_y0 = (pxy0*self.py0)/(pxy0*self.py0+pxy1*self.py1)
-        probs_y1 = (pxy1*self.py1)/(pxy0*self.py0+pxy1*self.py1)
-        return (probs_y1>probs_y0).astype(int)
+        log_probs = self.predict_log_proba(matrix)
+        return (log_probs[:,1]>log_probs[:,0]).astype(int)
+
+    def save(self, path):
+        np.savez(path, class_counts=self.class_counts, word_counts=self.word_counts)
+
+    @classmethod
+    def load(cls, path):
+        clf = cls()
+        with np.load(path) as data:
+            clf.class_counts = data['class_counts']
+            clf.word_counts = data['word_counts']
+        return clf
     
     def top5words(self,dictionary):
+        self.topkwords(dictionary,5)
+
+    def topkwords(self,dictionary,k):
+        # accept either the word->index dict or a Vocabulary, for O(1) index->word lookups
+        if not isinstance(dictionary,Vocabulary):
+            dictionary = Vocabulary.from_dict(dictionary)
         n = len(dictionary)
-        
+
         # approximate word's indicativeness of spam 
         spam_token_prob = np.log(self.phi1/self.phi0)
         assert(spam_token_prob.shape == (n,))
 
-        # get top 5 indexes associated with highest indicativeness
-        top5_idx = np.argsort(spam_token_prob)[::-1][:5]
-        
-        # for each of the top 5 indexes, find the word. 
-        # in the dict, the key is the word and the value is the index
-        # not an efficient implementation
-        list_top5 = []
-        for i in top5_idx:
-            for key in sorted(dictionary.keys()):
-                if dictionary[key] == i:
-                   list_top5.append(key)
-        print('top 5 words indicative of spam are:',list_top5)
+        # get top k indexes associated with highest indicativeness, without sorting all n
+        k = min(k,n)
+        topk_idx = np.argpartition(-spam_token_prob,k-1)[:k]
+        topk_idx = topk_idx[np.argsort(-spam_token_prob[topk_idx],kind='stable')]
+
+        list_topk = dictionary.words(topk_idx)
+        print('top {} words indicative of spam are:'.format(k),list_topk)
+        return list_topk
+
+
+class Vocabulary(collections.abc.Mapping):
+    """Mapping from words to column indices, backed by a contiguous word array.
+
+    The words are stored in index order as one UTF-8 blob plus an array of
+    n + 1 offsets, so looking up the word of an index is O(1). The hash index
+    from word to column is built on the first lookup in that direction.
+    save writes the offsets and the blob to a compact binary file, which
+    load memory-maps instead of parsing.
+    """
+    MAGIC = b'P06VOCAB'
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+        self._index = None
+
+    @classmethod
+    def from_words(cls, words):
+        """Build a vocabulary where words[i] has index i."""
+        encoded = [word.encode('utf8') for word in words]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(word) for word in encoded], out=offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(offsets, blob)
+
+    @classmethod
+    def from_dict(cls, dictionary):
+        """Build a vocabulary from a python dict mapping words to 0..n-1."""
+        words = [None] * len(dictionary)
+        for word, idx in dictionary.items():
+            words[idx] = word
+        return cls.from_words(words)
+
+    def word(self, idx):
+        """Return the word of column idx."""
+        return bytes(self.blob[self.offsets[idx]:self.offsets[idx + 1]]).decode('utf8')
+
+    def words(self, idxs):
+        """Return the list of words of the columns idxs."""
+        return [self.word(idx) for idx in idxs]
+
+    def __getitem__(self, word):
+        if self._index is None:
+            self._index = {w: idx for idx, w in enumerate(self)}
+        return self._index[word]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self.word(idx)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def save(self, path):
+        """Write the vocabulary as magic, word count, offsets and UTF-8 blob.
+
+        The file is written under a temporary name and then renamed onto
+        path, since truncating it in place would crash (SIGBUS) any process
+        that memory-mapped the previous version with load.
+        """
+        directory, basename = os.path.split(path)
+        tmp_path = os.path.join(directory, '.tmp-' + basename)
+        with open(tmp_path, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(np.array([len(self)], dtype='<i8').tobytes())
+            f.write(np.asarray(self.offsets, dtype='<i8').tobytes())
+            f.write(np.asarray(self.blob, dtype=np.uint8).tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a vocabulary written by save."""
+        with open(path, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError('{} is not a saved Vocabulary'.format(path))
+            n = int(np.frombuffer(f.read(8), dtype='<i8')[0])
+
+        header_size = len(cls.MAGIC) + 8
+        offsets = np.memmap(path, dtype='<i8', mode='r', offset=header_size, shape=(n + 1,))
+        if offsets[-1] == 0:
+            blob = np.zeros(0, dtype=np.uint8)
+        else:
+            blob = np.memmap(path, dtype=np.uint8, mode='r', offset=header_size + 8 * (n + 1),
+                             shape=(int(offsets[-1]),))
+        return cls(offsets, blob)
 
 
 def accuracy(predict, y):
     return sum(predict==y)/len(y)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--train_path', default='../data/ds6_train.tsv',
+                        help='Path to the training TSV file')
+    parser.add_argument('--val_path', default='../data/ds6_val.tsv',
+                        help='Path to the validation TSV file')
+    parser.add_argument('--test_path', default='../data/ds6_test.tsv',
+                        help='Path to the test TSV file')
+    parser.add_argument('--cache_dir', default='./output/p06_cache',
+                        help='Directory holding the cached stage results')
+    parser.add_argument('--radii', type=float, nargs='+', default=[0.01, 0.1, 1, 10],
+                        help='SVM radii to sweep')
+    parser.add_argument('--seed', type=int, default=123,
+                        help='Seed of the random state used to train the final SVM')
+    args = parser.parse_args()
+    main(args)
\ No newline at end of file
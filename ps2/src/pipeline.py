@@ -0,0 +1,176 @@
+"""A small dependency graph of computation stages with an on-disk artifact cache.
+
+Each stage is keyed by a hash of its name, the source of its function and
+of the functions, classes or modules it declares it calls, its parameters,
+the contents of its input files and the keys of the stages it depends on.
+Its result is saved in the cache directory under that key, so a stage only
+re-runs when something it depends on has changed; everything downstream of
+an unchanged stage is loaded from disk. Only the declared code is tracked:
+a stage calling an undeclared helper (or an installed package) is not
+invalidated when that helper changes.
+"""
+import collections
+import hashlib
+import inspect
+import json
+import os
+import pickle
+
+import numpy as np
+import scipy.sparse
+
+
+def _save_pickle(value, path):
+    with open(path, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _save_json(value, path):
+    with open(path, 'w') as f:
+        json.dump(value, f)
+
+
+def _load_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+# Artifact formats: name -> (file extension, save(value, path), load(path))
+FORMATS = {
+    'pickle': ('.pkl', _save_pickle, _load_pickle),
+    'json': ('.json', _save_json, _load_json),
+    'npy': ('.npy', lambda value, path: np.save(path, value), np.load),
+    'sparse': ('.npz', lambda value, path: scipy.sparse.save_npz(path, value), scipy.sparse.load_npz),
+}
+
+Stage = collections.namedtuple('Stage', ['name', 'func', 'deps', 'params', 'files', 'fmt', 'code'])
+
+
+def get_source(obj):
+    """Return the source of a function, class or module, or its name if unavailable."""
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        return getattr(obj, '__qualname__', repr(obj))
+
+
+def hash_file(path, block_size=1024 ** 2):
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Pipeline(object):
+    """Stages run in dependency order, with results cached by content hash."""
+
+    def __init__(self, cache_dir, verbose=True):
+        """
+        Args:
+            cache_dir: Directory holding the cached artifacts.
+            verbose: Print whether each stage was loaded or computed.
+        """
+        self.cache_dir = cache_dir
+        self.verbose = verbose
+        self.stages = collections.OrderedDict()
+        self.computed = set()
+        self._keys = {}
+        self._file_hashes = {}
+
+    def add(self, name, func, deps=(), params=None, files=None, fmt='pickle', code=()):
+        """Add a stage computing func(*dep_results, **params, **files).
+
+        Args:
+            name: Unique name of the stage.
+            func: Function computing the stage result.
+            deps: Names of the stages whose results are passed positionally.
+            params: Dict of JSON-serializable keyword arguments.
+            files: Dict of keyword arguments that are input file paths, hashed by content.
+            fmt: A key of FORMATS, or an (extension, save, load) tuple.
+            code: Functions, classes or modules func calls, whose source is hashed with its own.
+        """
+        if name in self.stages:
+            raise ValueError('Duplicate stage: {}'.format(name))
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError('Stage {} depends on unknown stage {}'.format(name, dep))
+        self.stages[name] = Stage(name, func, tuple(deps), params or {}, files or {}, fmt,
+                                  tuple(code))
+
+    def key(self, name):
+        """Return the cache key of a stage, derived from everything it depends on."""
+        if name not in self._keys:
+            stage = self.stages[name]
+            description = {
+                'name': name,
+                'source': [get_source(obj) for obj in (stage.func,) + stage.code],
+                'params': stage.params,
+                'files': {arg: self._hash_file(path) for arg, path in stage.files.items()},
+                'deps': [self.key(dep) for dep in stage.deps],
+            }
+            encoded = json.dumps(description, sort_keys=True, default=repr).encode('utf8')
+            self._keys[name] = hashlib.sha256(encoded).hexdigest()[:16]
+        return self._keys[name]
+
+    def path(self, name):
+        """Return the cache path of a stage's artifact."""
+        extension = self._format(name)[0]
+        return os.path.join(self.cache_dir, '{}-{}{}'.format(name, self.key(name), extension))
+
+    def run(self, *names):
+        """Compute or load the given stages (default: all) and their dependencies.
+
+        Returns:
+            A dict mapping stage names to their results.
+        """
+        results = {}
+        for name in names or self.stages:
+            self._run(name, results)
+        return results
+
+    def _run(self, name, results):
+        if name in results:
+            return results[name]
+        stage = self.stages[name]
+        _, save, load = self._format(name)
+        path = self.path(name)
+
+        if os.path.exists(path):
+            if self.verbose:
+                print('[pipeline] {}: cached'.format(name))
+            results[name] = load(path)
+            return results[name]
+
+        args = [self._run(dep, results) for dep in stage.deps]
+        kwargs = dict(stage.params)
+        kwargs.update(stage.files)
+        if self.verbose:
+            print('[pipeline] {}: computing'.format(name))
+        result = stage.func(*args, **kwargs)
+
+        # Write under a temporary name first so an interrupted run leaves no partial artifact
+        os.makedirs(self.cache_dir, exist_ok=True)
+        directory, basename = os.path.split(path)
+        tmp_path = os.path.join(directory, '.tmp-' + basename)
+        save(result, tmp_path)
+        os.replace(tmp_path, path)
+
+        self.computed.add(name)
+        results[name] = result
+        return result
+
+    def _format(self, name):
+        fmt = self.stages[name].fmt
+        return FORMATS[fmt] if isinstance(fmt, str) else fmt
+
+    def _hash_file(self, path):
+        if path not in self._file_hashes:
+            self._file_hashes[path] = hash_file(path)
+        return self._file_hashes[path]
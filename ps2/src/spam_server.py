@@ -0,0 +1,286 @@
+"""Long-running spam scorer for models persisted by p06_spam.main.
+
+Messages arrive one per line, either on stdin or over a local TCP socket,
+and are grouped into micro-batches: a batch is scored as soon as it holds
+`max_batch_size` messages or its oldest message has waited `max_latency`
+seconds. Each batch is vectorized and scored with a single predict call.
+Replies are 'spam' or 'ham', one per line, in request order. Latency and
+throughput statistics are printed to stderr every `stats_every` seconds and
+at shutdown.
+"""
+import argparse
+import collections
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+import p06_spam
+import svm
+
+LABELS = ['ham', 'spam']
+
+
+def load_scorer(vocabulary_path, model_path):
+    """Load a persisted vocabulary and model into a batch scoring function.
+
+    Args:
+        vocabulary_path: Path of a Vocabulary written by Vocabulary.save.
+        model_path: Path of a naive_bayes.save or svm.save_model file.
+
+    Returns:
+        A function mapping a list of messages to an array of 0/1 predictions.
+    """
+    vocabulary = p06_spam.Vocabulary.load(vocabulary_path)
+    with np.load(model_path) as data:
+        is_naive_bayes = 'word_counts' in data.files
+
+    if is_naive_bayes:
+        clf = p06_spam.naive_bayes.load(model_path)
+        predict = clf.predict
+    else:
+        state, radius = svm.load_model(model_path)
+
+        def predict(matrix):
+            return svm.predict(state, matrix, radius)
+
+    def score(messages):
+        return predict(p06_spam.transform_text(messages, vocabulary))
+
+    return score
+
+
+class MicroBatcher(object):
+    """Collect concurrent scoring requests into batches for one vectorized call."""
+
+    def __init__(self, score, max_batch_size=256, max_latency=0.005, history=100000):
+        """
+        Args:
+            score: Function mapping a list of messages to an array of predictions.
+            max_batch_size: Largest number of messages scored together.
+            max_latency: Longest time (in seconds) a message waits for its batch to fill.
+            history: Number of recent request latencies kept for the statistics.
+        """
+        self.score = score
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.latencies = collections.deque(maxlen=history)
+        self.num_scored = 0
+        self.num_batches = 0
+        self.busy_time = 0.
+        self.start_time = time.time()
+        self._stats_lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, message):
+        """Queue a message and return a Future resolving to its 0/1 prediction."""
+        future = Future()
+        self._requests.put((time.time(), message, future))
+        return future
+
+    def close(self):
+        """Score the requests already queued, then stop the worker."""
+        self._requests.put(None)
+        self._worker.join()
+
+    def stats(self):
+        """Return p50/p99 latency (ms), message rates (messages/s) and batch counts.
+
+        'throughput' is the number of messages scored per second spent inside
+        score, i.e. what the server can sustain; 'request_rate' is the number
+        of messages scored per second since the batcher started, idle time
+        included, i.e. the load it actually received.
+        """
+        with self._stats_lock:
+            latencies = np.array(self.latencies) * 1000
+            num_scored = self.num_scored
+            num_batches = self.num_batches
+            busy_time = self.busy_time
+        elapsed = time.time() - self.start_time
+        return {
+            'p50_ms': np.percentile(latencies, 50) if len(latencies) else 0.,
+            'p99_ms': np.percentile(latencies, 99) if len(latencies) else 0.,
+            'throughput': num_scored / busy_time if busy_time > 0 else 0.,
+            'request_rate': num_scored / elapsed if elapsed > 0 else 0.,
+            'messages': num_scored,
+            'batches': num_batches,
+        }
+
+    def _run(self):
+        closing = False
+        while not closing:
+            request = self._requests.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = request[0] + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.time()
+                try:
+                    request = self._requests.get(timeout=timeout) if timeout > 0 else self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    closing = True
+                    break
+                batch.append(request)
+            self._score_batch(batch)
+
+    def _score_batch(self, batch):
+        start = time.time()
+        try:
+            preds = self.score([message for _, message, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        done = time.time()
+        with self._stats_lock:
+            self.latencies.extend(done - submitted for submitted, _, _ in batch)
+            self.num_scored += len(batch)
+            self.num_batches += 1
+            self.busy_time += done - start
+        for (_, _, future), pred in zip(batch, preds):
+            future.set_result(int(pred))
+
+
+class ScoringHandler(socketserver.StreamRequestHandler):
+    """Score each line received on a connection, replying in order.
+
+    Lines are submitted as soon as they are read and replies are written by a
+    separate thread, so a client may pipeline many messages on one connection.
+    """
+
+    def handle(self):
+        pending = queue.Queue()
+        writer = threading.Thread(target=self._write_replies, args=(pending,))
+        writer.start()
+        for line in self.rfile:
+            pending.put(self.server.batcher.submit(line.decode('utf8').rstrip('\r\n')))
+        pending.put(None)
+        writer.join()
+
+    def _write_replies(self, pending):
+        for future in iter(pending.get, None):
+            self.wfile.write((LABELS[future.result()] + '\n').encode('utf8'))
+            self.wfile.flush()
+
+
+class ScoringServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, batcher):
+        socketserver.TCPServer.__init__(self, address, ScoringHandler)
+        self.batcher = batcher
+
+
+def score_messages(messages, host='127.0.0.1', port=2290):
+    """Send messages to a running server over one connection and return the replies.
+
+    Args:
+        messages: A list of strings, each a single-line SMS message.
+        host: Server host.
+        port: Server port.
+
+    Returns:
+        The list of 'spam' / 'ham' replies, in the order of messages.
+    """
+    with socket.create_connection((host, port)) as conn:
+        def send():
+            for message in messages:
+                conn.sendall((message.replace('\n', ' ') + '\n').encode('utf8'))
+            conn.shutdown(socket.SHUT_WR)
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        with conn.makefile('r', encoding='utf8') as replies:
+            labels = [reply.rstrip('\n') for reply in replies]
+        sender.join()
+    return labels
+
+
+def print_stats(batcher, out=sys.stderr):
+    stats = batcher.stats()
+    print('scored {messages} messages in {batches} batches: p50 {p50_ms:.2f} ms, '
+          'p99 {p99_ms:.2f} ms, {throughput:.1f} messages/s scoring, '
+          '{request_rate:.1f} messages/s received'.format(**stats), file=out)
+
+
+def report_stats(batcher, interval, stop, out=sys.stderr):
+    """Print the batcher statistics every `interval` seconds until `stop` is set."""
+    while not stop.wait(interval):
+        print_stats(batcher, out)
+
+
+def serve_stdin(batcher, stdin=sys.stdin, stdout=sys.stdout):
+    """Score the lines of stdin, writing one reply per line in order."""
+    pending = queue.Queue()
+
+    def read():
+        for line in stdin:
+            pending.put(batcher.submit(line.rstrip('\r\n')))
+        pending.put(None)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    for future in iter(pending.get, None):
+        stdout.write(LABELS[future.result()] + '\n')
+        stdout.flush()
+
+
+def main(args):
+    score = load_scorer(args.vocabulary, args.model)
+    batcher = MicroBatcher(score, args.max_batch_size, args.max_latency_ms / 1000.)
+    stop_reporting = threading.Event()
+    if args.stats_every > 0:
+        threading.Thread(target=report_stats, args=(batcher, args.stats_every, stop_reporting),
+                         daemon=True).start()
+
+    if args.stdin:
+        serve_stdin(batcher)
+    else:
+        server = ScoringServer((args.host, args.port), batcher)
+        print('[INFO] Scoring on {}:{}'.format(args.host, args.port), file=sys.stderr)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            server.server_close()
+
+    batcher.close()
+    stop_reporting.set()
+    print_stats(batcher)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vocabulary', default='./output/p06_vocabulary',
+                        help='Path to the saved vocabulary')
+    parser.add_argument('--model', default='./output/p06_naive_bayes.npz',
+                        help='Path to the saved naive Bayes or SVM model')
+    parser.add_argument('--stdin', action='store_true',
+                        help='Score lines from stdin instead of a socket')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('--port', type=int, default=2290,
+                        help='Port to listen on')
+    parser.add_argument('--max_batch_size', type=int, default=256,
+                        help='Largest number of messages scored together')
+    parser.add_argument('--max_latency_ms', type=float, default=5.,
+                        help='Longest time a message waits for its batch to fill')
+    parser.add_argument('--stats_every', type=float, default=60.,
+                        help='Seconds between statistics reports (0 to only report at shutdown)')
+    args = parser.parse_args()
+    main(args)
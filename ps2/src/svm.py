@@ -1,71 +1,709 @@
 # Important note: you do not have to modify this file for your homework.
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import scipy.sparse
 np.random.seed(123)
 
+# Largest kernel buffer (in bytes) held at once. The train Gram matrix is kept
+# whole only if it fits; otherwise rows are evaluated on demand.
+MAX_KERNEL_BYTES = 256 * 1024 ** 2
+
+# The solvers stop once the predicted labels of PROBE_SIZE evenly spaced
+# training examples have stayed (nearly) unchanged for STABLE_EPOCHS epochs
+PROBE_SIZE = 1024
+STABLE_EPOCHS = 2
+
 
-def train_and_predict_svm(train_matrix, train_labels, test_matrix, radius):
+def train_and_predict_svm(train_matrix, train_labels, test_matrix, radius,
+                          max_memory=MAX_KERNEL_BYTES, dtype=np.float64, mode='exact',
+                          n_components=1000):
     """Train an SVM model and predict the resulting labels on a test set.
 
-    Args: 
-        train_matrix: A numpy array containing the word counts for the train set
+    With mode='exact' this trains the kernel SVM of svm_train. With
+    mode='rff' the RBF kernel is approximated with `n_components` random
+    Fourier features and a linear model is trained on them (see rff_train),
+    which makes prediction cost independent of the training set size.
+
+    Args:
+        train_matrix: A numpy array or sparse matrix containing the word counts for the train set
         train_labels: A numpy array containing the spam or not spam labels for the train set
-        test_matrix: A numpy array containing the word counts for the test set
+        test_matrix: A numpy array or sparse matrix containing the word counts for the test set
         radius: The RBF kernel radius to use for the SVM
+        max_memory: The largest kernel buffer to allocate, in bytes
+        dtype: The float type used to store the kernel
+        mode: Either 'exact' or 'rff'
+        n_components: Number of random Fourier features in 'rff' mode
 
-    Return: 
+    Return:
         The predicted labels for each message
     """
-    model = svm_train(train_matrix, train_labels, radius)
-    return svm_predict(model, test_matrix, radius)
+    if mode == 'rff':
+        model = rff_train(train_matrix, train_labels, radius, n_components, max_memory, dtype)
+        return rff_predict(model, test_matrix, max_memory)
+    if mode != 'exact':
+        raise ValueError('Unknown SVM mode: {}'.format(mode))
+    model = svm_train(train_matrix, train_labels, radius, max_memory, dtype)
+    return svm_predict(model, test_matrix, radius, max_memory, dtype)
 
 
-def svm_train(matrix, category, radius):
-    state = {}
+def pack_binary(matrix, max_memory=MAX_KERNEL_BYTES):
+    """Pack the 0/1 word indicators of each row into 64-bit words.
+
+    Args:
+        matrix: A numpy array or scipy.sparse matrix of word counts, of shape (m, n)
+        max_memory: The largest block of dense indicators to allocate, in bytes
+
+    Returns:
+        A uint64 array of shape (m, ceil(n / 64)) holding one bit per word
+    """
     M, N = matrix.shape
+    packed = np.zeros((M, -(-N // 64) * 8), dtype=np.uint8)
+    # A block holds its bool indicators and their packed bits
+    for rows in row_blocks(M, N, 2, max_memory):
+        block = matrix[rows] != 0
+        if scipy.sparse.issparse(block):
+            block = block.toarray()
+        packed[rows, :(N + 7) // 8] = np.packbits(block, axis=1)
+    return packed.view(np.uint64)
+
+
+if hasattr(np, 'bitwise_count'):
+    popcount = np.bitwise_count
+    # Bytes of temporaries packed_dot allocates per output element: the uint64
+    # x & y words and their uint8 popcounts
+    PACKED_DOT_TEMP_BYTES = 9
+else:
+    _BYTE_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    PACKED_DOT_TEMP_BYTES = 17
+
+    def popcount(words, out=None):
+        """Count the set bits of each element of a contiguous uint64 array."""
+        counts = _BYTE_POPCOUNT[words.view(np.uint8)]
+        return counts.reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8, out=out)
+
+
+def packed_dot(x, y, out=None, dtype=np.float64):
+    """Compute the dot products between bit-packed rows of x and y.
+
+    For 0/1 vectors x.y is the number of bits set in both, so the Gram matrix
+    is accumulated one 64-bit word at a time as popcount(x & y). Besides out,
+    this needs PACKED_DOT_TEMP_BYTES of temporaries per output element, which
+    callers include when sizing their blocks.
+
+    Each word is read as a column y[:, w], so y should be stored in Fortran
+    order (np.asfortranarray) to make those reads contiguous; callers keep
+    such a copy of the training set.
+
+    Args:
+        x: Packed matrix of shape (m, w), see pack_binary
+        y: Packed matrix of shape (p, w), preferably Fortran-ordered
+        out: Optional (m, p) buffer to write into
+        dtype: The float type of the result when out is not given
+
+    Returns:
+        The (m, p) Gram matrix
+    """
+    if out is None:
+        out = np.zeros((x.shape[0], y.shape[0]), dtype=dtype)
+    else:
+        out[...] = 0
+    x = np.asfortranarray(x)
+    words = np.empty(out.shape, dtype=np.uint64)
+    counts = np.empty(out.shape, dtype=np.uint8)
+    for w in range(x.shape[1]):
+        np.bitwise_and(x[:, w, None], y[None, :, w], out=words)
+        out += popcount(words, out=counts)
+    return out
+
+
+def row_blocks(num_rows, num_cols, itemsize, max_memory=MAX_KERNEL_BYTES):
+    """Yield row slices whose (rows, num_cols) buffers fit in max_memory bytes.
+
+    itemsize is the total number of bytes allocated per element of a block,
+    temporaries included. Blocks hold at least one row.
+    """
+    step = max(1, int(max_memory // (num_cols * itemsize)))
+    for start in range(0, num_rows, step):
+        yield slice(start, min(start + step, num_rows))
+
+
+def sq_distances(x, sq_x, y, sq_y, out=None, dtype=np.float64):
+    """Compute the squared euclidean distances between the bit-packed rows of x and y.
+
+    The distances are assembled inside the (len(x), len(y)) Gram buffer, so
+    no other temporaries of that size are kept.
+
+    Args:
+        x: Packed matrix of shape (m, w)
+        sq_x: Squared norms (number of set bits) of the rows of x
+        y: Packed matrix of shape (p, w)
+        sq_y: Squared norms of the rows of y
+        out: Optional (m, p) buffer to write into
+        dtype: The float type of the result when out is not given
+
+    Returns:
+        The (m, p) matrix of squared distances
+    """
+    out = packed_dot(x, y, out=out, dtype=dtype)
+    return gram_to_sq_distances(out, sq_x, sq_y)
+
+
+def gram_to_sq_distances(gram, sq_x, sq_y):
+    """Turn dot products into squared distances |x|^2 + |y|^2 - 2 x.y, in place."""
+    gram *= -2
+    gram += sq_x.reshape((-1, 1))
+    gram += sq_y.reshape((1, -1))
+    return gram
+
+
+def rbf_from_distances(distances, radius, out=None):
+    """Turn squared distances into RBF kernel values, in place if out is distances."""
+    out = np.multiply(distances, -1. / (2 * (radius ** 2)), out=out)
+    np.exp(out, out=out)
+    return out
+
+
+def rbf_decisions(distances, radius, alpha, out=None):
+    """Return decision values with the signs of exp(-distances / (2 radius^2)).dot(alpha).
+
+    Each kernel row is scaled by exp(min_j d_ij / (2 radius^2)), a positive
+    factor that keeps the sign of its decision value, so that its largest
+    entry is 1. Unscaled, a row far from every training example underflows
+    to all zeros (beyond d ~ 200 radius^2 in float32, ~1500 radius^2 in
+    float64) and gets the decision value 0, i.e. is predicted ham. The
+    kernel is computed in out, which may be distances.
+    """
+    out = np.subtract(distances, distances.min(axis=1, keepdims=True), out=out)
+    rbf_from_distances(out, radius, out=out)
+    return out.dot(alpha)
+
+
+def rbf_block(x, sq_x, y, sq_y, radius, out=None, dtype=np.float64):
+    """Compute the RBF kernel between the packed rows of x and y (see sq_distances)."""
+    out = sq_distances(x, sq_x, y, sq_y, out=out, dtype=dtype)
+    return rbf_from_distances(out, radius, out=out)
+
+
+def pairwise_sq_distances(x, sq_x, y, sq_y, max_memory=MAX_KERNEL_BYTES, dtype=np.float64):
+    """Compute the full (len(x), len(y)) squared distance matrix block by block.
+
+    The blocks are sized so that the matrix plus the temporaries of one block
+    fit in max_memory bytes when possible.
+    """
+    out = np.empty((x.shape[0], y.shape[0]), dtype=dtype)
+    y = np.asfortranarray(y)
+    for rows in row_blocks(x.shape[0], y.shape[0], PACKED_DOT_TEMP_BYTES, max_memory - out.nbytes):
+        sq_distances(x[rows], sq_x[rows], y, sq_y, out=out[rows])
+    return out
+
+
+class RBFKernel(object):
+    """The RBF Gram matrix of a training set, either stored or computed by rows.
+
+    The matrix is precomputed block by block when it fits in `max_memory`
+    bytes. Otherwise each call to `rows` evaluates just the requested rows,
+    which keeps memory at O(batch * M) however large the training set grows.
+
+    If the squared `distances` between training examples are already known
+    (see svm_radius_sweep), the kernel is derived from them instead of being
+    recomputed from the features. When rows are evaluated on demand from a
+    scipy.sparse training set, their dot products are a sparse matrix
+    product, which is much faster than popcounts over every packed word.
+    """
+
+    def __init__(self, matrix, squared, radius, max_memory=MAX_KERNEL_BYTES, distances=None,
+                 dtype=np.float64, sparse=None):
+        """
+        Args:
+            matrix: Packed training set, see pack_binary
+            squared: Squared norms of the rows of matrix
+            radius: The RBF kernel radius
+            max_memory: The largest stored Gram matrix, in bytes
+            distances: Optional precomputed squared distances between training examples
+            dtype: The float type used to store the kernel
+            sparse: Optional scipy.sparse word counts that matrix was packed from
+        """
+        self.matrix = matrix
+        # Contiguous word columns for packed_dot
+        self.columns = np.asfortranarray(matrix)
+        self.squared = squared
+        self.radius = radius
+        self.distances = distances
+        self.dtype = dtype
+        self.K = None
+        self.binary = None
+
+        M = matrix.shape[0]
+        itemsize = np.dtype(dtype).itemsize
+        temp_bytes = 0 if distances is not None else PACKED_DOT_TEMP_BYTES
+        if M * M * itemsize + M * temp_bytes <= max_memory:
+            self.K = np.empty((M, M), dtype=dtype)
+            for rows in row_blocks(M, M, max(temp_bytes, 1), max_memory - self.K.nbytes):
+                if distances is not None:
+                    rbf_from_distances(distances[rows], radius, out=self.K[rows])
+                else:
+                    rbf_block(matrix[rows], squared[rows], self.columns, squared, radius, out=self.K[rows])
+        elif distances is None and scipy.sparse.issparse(sparse):
+            self.binary = (sparse != 0).astype(dtype).tocsr()
+            self.binary_t = self.binary.T.tocsr()
+
+    def sq_distance_rows(self, idx):
+        """Return the squared distances between the examples idx and every training example."""
+        if self.distances is not None:
+            return self.distances[idx]
+        if self.binary is not None:
+            gram = (self.binary[idx] @ self.binary_t).toarray()
+            return gram_to_sq_distances(gram, self.squared[idx], self.squared)
+        return sq_distances(self.matrix[idx], self.squared[idx], self.columns, self.squared, dtype=self.dtype)
+
+    def rows(self, idx):
+        """Return K[idx, :], which by symmetry is also K[:, idx].T."""
+        if self.K is not None:
+            return self.K[idx]
+        distances = self.sq_distance_rows(idx)
+        return rbf_from_distances(distances, self.radius, out=distances)
+
+
+def svm_radius_sweep(train_matrix, train_labels, test_matrix, radii,
+                     max_memory=MAX_KERNEL_BYTES, dtype=np.float64, max_workers=None, seed=123):
+    """Train and evaluate an SVM for each radius, sharing the distance computations.
+
+    Only the final exp(-d / (2 r^2)) depends on the radius. When the
+    train/train and test/train squared distances fit in max_memory, they are
+    computed once and the radii are trained in a thread pool that derives each
+    kernel from them. A radius also stores its own train kernel only if that
+    fits in its share of the remaining memory, which caps the number of radii
+    trained at once.
+
+    Otherwise the radii are trained in lockstep: every radius uses a random
+    state seeded with `seed`, so they all sample the same batches, and the
+    distance rows of each batch (and of each block of test rows) are computed
+    once and exponentiated for every radius in turn. The results are the same
+    either way.
+
+    Args:
+        train_matrix: A numpy array or sparse matrix containing the word counts for the train set
+        train_labels: A numpy array containing the spam or not spam labels for the train set
+        test_matrix: A numpy array or sparse matrix containing the word counts for the test set
+        radii: The RBF kernel radii to evaluate
+        max_memory: The largest total distance and kernel buffers to allocate, in bytes
+        dtype: The float type used to store the distances and the kernel
+        max_workers: Largest number of radii trained concurrently when the distances are stored
+        seed: Seed for the random state of each radius
+
+    Returns:
+        A list with the predicted labels for each radius, in the order of radii
+    """
+    train = pack_binary(train_matrix, max_memory)
+    test = pack_binary(test_matrix, max_memory)
+    sq_train = popcount(train).sum(axis=1)
+    sq_test = popcount(test).sum(axis=1)
+    M, P = train.shape[0], test.shape[0]
+    itemsize = np.dtype(dtype).itemsize
+
+    distance_bytes = (M + P) * M * itemsize
+    if distance_bytes + M * PACKED_DOT_TEMP_BYTES > max_memory:
+        return _svm_radius_lockstep(train_matrix, train, sq_train, train_labels, test, sq_test, radii,
+                                    max_memory, dtype, seed)
+
+    train_distances = pairwise_sq_distances(train, sq_train, train, sq_train,
+                                            max_memory - P * M * itemsize, dtype)
+    test_distances = pairwise_sq_distances(test, sq_test, train, sq_train,
+                                           max_memory - train_distances.nbytes, dtype)
+
+    # Each concurrent radius gets an equal share of the memory left; radii
+    # whose share cannot hold an M x M kernel derive its rows on demand
+    remaining = max_memory - distance_bytes
+    workers = min(max_workers or len(radii), len(radii))
+    kernel_bytes = M * M * itemsize
+    if remaining >= kernel_bytes:
+        workers = min(workers, remaining // kernel_bytes)
+    share = remaining // workers
+
+    def evaluate(radius):
+        state = svm_train(train_matrix, train_labels, radius, share, dtype,
+                          distances=train_distances, rng=np.random.RandomState(seed))
+        return svm_predict(state, test_matrix, radius, share, dtype, distances=test_distances)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(evaluate, radii))
+
+
+def _svm_radius_lockstep(train_matrix, train, sq_train, train_labels, test, sq_test, radii, max_memory, dtype, seed):
+    """Train and evaluate one SVM per radius, computing each distance block once (see svm_radius_sweep)."""
+    M, P = train.shape[0], test.shape[0]
+    Y = 2 * train_labels - 1
+    # Never stores a Gram matrix, only provides distance rows
+    kernel = RBFKernel(train, sq_train, None, 0, dtype=dtype, sparse=train_matrix)
+
+    def kernel_rows(idx, models):
+        distances = kernel.sq_distance_rows(idx)
+        K_batch = np.empty_like(distances)
+        for j in models:
+            yield rbf_from_distances(distances, radii[j], out=K_batch)
+
+    _, alpha_avg = _svm_sgd(kernel_rows, Y, len(radii), np.random.RandomState(seed))
+
+    # A block holds its distances, one kernel buffer and the packed_dot temporaries
+    preds = np.zeros((len(radii), P))
+    itemsize = 2 * np.dtype(dtype).itemsize + PACKED_DOT_TEMP_BYTES
+    blocks = list(row_blocks(P, M, itemsize, max_memory))
+    block_rows = blocks[0].stop - blocks[0].start if blocks else 0
+    distance_buffer = np.empty((block_rows, M), dtype=dtype)
+    kernel_buffer = np.empty((block_rows, M), dtype=dtype)
+    for rows in blocks:
+        distances = sq_distances(test[rows], sq_test[rows], kernel.columns, sq_train,
+                                 out=distance_buffer[:rows.stop - rows.start])
+        K = kernel_buffer[:rows.stop - rows.start]
+        for j, radius in enumerate(radii):
+            preds[j, rows] = rbf_decisions(distances, radius, alpha_avg[j], out=K)
+    return list((1 + np.sign(preds)) // 2)
+
+
+def svm_train(matrix, category, radius, max_memory=MAX_KERNEL_BYTES, dtype=np.float64,
+              distances=None, rng=None, batch_size=32, tol=1e-3):
+    """Train an RBF kernel SVM with mini-batch stochastic gradient descent.
+
+    Each step samples `batch_size` examples, fetches their kernel rows at once
+    and applies the averaged regularization and hinge-loss gradients with two
+    matrix-vector products. With batch_size=1 this is the original
+    single-example solver. Training stops after 10 epochs, or earlier once the
+    averaged model's labels for a probe of training examples have settled:
+    STABLE_EPOCHS epochs in a row flip at most a fraction `tol` of them.
+
+    Args:
+        matrix: A numpy array or sparse matrix containing the word counts for the train set
+        category: The spam or not spam labels for the train set
+        radius: The RBF kernel radius to use for the SVM
+        max_memory: The largest kernel buffer to allocate, in bytes
+        dtype: The float type used to store the kernel
+        distances: Optional precomputed squared distances between training examples
+        rng: Random state used to sample examples (default: the global numpy one)
+        batch_size: Number of examples per gradient step
+        tol: Fraction of probe labels an epoch may flip and still count as settled
+
+    Returns:
+        The model state used by svm_predict
+    """
+    state = {}
     Y = 2 * category - 1
-    matrix = 1. * (matrix > 0)
-    squared = np.sum(matrix * matrix, axis=1)
-    gram = matrix.dot(matrix.T)
-    K = np.exp(-(squared.reshape((1, -1)) + squared.reshape((-1, 1)) - 2 * gram) / (2 * (radius ** 2)))
+    rng = np.random if rng is None else rng
+    packed = pack_binary(matrix, max_memory)
+    squared = popcount(packed).sum(axis=1)
+    kernel = RBFKernel(packed, squared, radius, max_memory, distances, dtype, sparse=matrix)
+
+    alpha, alpha_avg = _svm_sgd(lambda idx, models: [kernel.rows(idx)], Y, 1, rng, batch_size, tol)
+
+    state['alpha'] = alpha[0]
+    state['alpha_avg'] = alpha_avg[0]
+    state['Xtrain'] = packed
+    state['Sqtrain'] = squared
+    return state
+
+
+def _svm_sgd(kernel_rows, Y, num_models, rng, batch_size=32, tol=1e-3):
+    """Run the mini-batch solver of svm_train for several kernels on the same batches.
 
-    alpha = np.zeros(M)
-    alpha_avg = np.zeros(M)
+    Args:
+        kernel_rows: Function of (idx, models) yielding the kernel rows K[idx]
+            of each model index in models, in order
+        Y: The +1/-1 labels of the training set
+        num_models: Number of kernels trained together
+        rng: Random state used to sample examples
+        batch_size: Number of examples per gradient step
+        tol: Fraction of probe labels an epoch may flip and still count as settled
+
+    Returns:
+        The final alpha and the normalized averaged alpha of each model, of shape (num_models, M)
+    """
+    M = len(Y)
+    alpha = np.zeros((num_models, M))
+    alpha_avg = np.zeros((num_models, M))
+    num_steps = np.zeros(num_models)
+    probe = probe_indices(M)
+    settled = [ProbeCheck(tol) for _ in range(num_models)]
     L = 1. / (64 * M)
     outer_loops = 10
+    steps_per_loop = -(-M // batch_size)
 
-    alpha_avg = 0
+    models = list(range(num_models))
     ii = 0
-    while ii < outer_loops * M:
-        i = int(np.random.rand() * M)
-        margin = Y[i] * np.dot(K[i, :], alpha)
-        grad = M * L * K[:, i] * alpha[i]
-        if margin < 1:
-            grad -= Y[i] * K[:, i]
-        alpha -= grad / np.sqrt(ii + 1)
-        alpha_avg += alpha
+    while models and ii < outer_loops * steps_per_loop:
+        idx = (rng.rand(batch_size) * M).astype(int)
+        for j, K_batch in zip(models, kernel_rows(idx, models)):
+            margins = Y[idx] * K_batch.dot(alpha[j])
+            coef = M * L * alpha[j, idx] - Y[idx] * (margins < 1)
+            grad = K_batch.T.dot(coef) / batch_size
+            alpha[j] -= grad / np.sqrt(ii + 1)
+            alpha_avg[j] += alpha[j]
         ii += 1
+        num_steps[models] = ii
 
-    alpha_avg /= (ii + 1) * M
+        if ii % steps_per_loop == 0:
+            # Decision values of the averaged alphas on the probe, batch_size rows at a time
+            decisions = np.zeros((num_models, len(probe)))
+            for start in range(0, len(probe), batch_size):
+                rows = probe[start:start + batch_size]
+                for j, K_rows in zip(models, kernel_rows(rows, models)):
+                    decisions[j, start:start + len(rows)] = K_rows.dot(alpha_avg[j])
+            for j in list(models):
+                if settled[j].update(decisions[j]):
+                    models.remove(j)
+
+    alpha_avg /= ((num_steps + 1) * M)[:, None]
+    return alpha, alpha_avg
+
+
+def probe_indices(num_examples, size=PROBE_SIZE):
+    """Return evenly spaced example indices used to check that training has settled."""
+    return np.unique(np.linspace(0, num_examples - 1, min(num_examples, size)).astype(int))
+
+
+class ProbeCheck(object):
+    """Detect that a model's predicted labels on a probe have stopped changing.
+
+    The averaged weights drift by about 1/epoch by construction, so their
+    change never reaches a small tolerance; the labels they predict do settle.
+    """
+
+    def __init__(self, tol=1e-3, stable_epochs=STABLE_EPOCHS):
+        self.tol = tol
+        self.stable_epochs = stable_epochs
+        self.labels = None
+        self.num_stable = 0
+
+    def update(self, decisions):
+        """Record the decision values after an epoch and return whether training has settled."""
+        labels = decisions > 0
+        if self.labels is not None and np.mean(labels != self.labels) <= self.tol:
+            self.num_stable += 1
+        else:
+            self.num_stable = 0
+        self.labels = labels
+        return self.num_stable >= self.stable_epochs
+
+
+def save_model(path, state, radius):
+    """Save an SVM state (from svm_train, svm_compact or rff_train) with its radius."""
+    np.savez(path, radius=radius, **state)
+
+
+def load_model(path):
+    """Load a model written by save_model.
+
+    Returns:
+        The model state and its RBF kernel radius
+    """
+    with np.load(path) as data:
+        state = {key: data[key] for key in data.files}
+    radius = float(state.pop('radius'))
+    return state, radius
+
+
+def predict(state, matrix, radius, max_memory=MAX_KERNEL_BYTES):
+    """Predict labels with either an exact ('Xtrain') or a random feature ('W') model."""
+    if 'W' in state:
+        return rff_predict(state, matrix, max_memory)
+    return svm_predict(state, matrix, radius, max_memory)
+
+
+def svm_compact(state, tol=0.01, radius=None, matrix=None, labels=None):
+    """Keep only the support vectors of a trained SVM.
+
+    Examples whose |alpha_avg| is below `tol` times the largest one barely
+    contribute to the decision function, so they are dropped from the model.
+    Prediction cost and model size then scale with the number of support
+    vectors rather than with M. If a labelled evaluation set is given, the
+    change in accuracy caused by the compaction is printed and stored in
+    state['accuracy_delta'].
+
+    Args:
+        state: The model state returned by svm_train
+        tol: Threshold on |alpha_avg|, relative to its largest entry
+        radius: The RBF kernel radius used for training (for the evaluation)
+        matrix: Optional word counts of an evaluation set
+        labels: Labels of the evaluation set
+
+    Returns:
+        A new model state holding only the support vectors
+    """
+    alpha_avg = state['alpha_avg']
+    keep = np.abs(alpha_avg) >= tol * np.max(np.abs(alpha_avg))
+
+    compact = {}
+    compact['alpha'] = state['alpha'][keep]
+    compact['alpha_avg'] = alpha_avg[keep]
+    compact['Xtrain'] = state['Xtrain'][keep]
+    compact['Sqtrain'] = state['Sqtrain'][keep]
+    print('Kept {} of {} training examples as support vectors'.format(np.sum(keep), len(keep)))
+
+    if matrix is not None:
+        full_accuracy = np.mean(svm_predict(state, matrix, radius) == labels)
+        compact_accuracy = np.mean(svm_predict(compact, matrix, radius) == labels)
+        compact['accuracy_delta'] = compact_accuracy - full_accuracy
+        print('Accuracy changed by {:+.4f} ({:.4f} -> {:.4f})'
+              .format(compact['accuracy_delta'], full_accuracy, compact_accuracy))
+    return compact
 
-    state['alpha'] = alpha
-    state['alpha_avg'] = alpha_avg
-    state['Xtrain'] = matrix
-    state['Sqtrain'] = squared
-    return state
 
+def svm_predict(state, matrix, radius, max_memory=MAX_KERNEL_BYTES, dtype=np.float64,
+                distances=None):
+    """Predict labels with a trained SVM, one block of test rows at a time.
 
-def svm_predict(state, matrix, radius):
+    Args:
+        state: The model state returned by svm_train
+        matrix: A numpy array or sparse matrix containing the word counts for the test set
+        radius: The RBF kernel radius used for training
+        max_memory: The largest kernel buffer to allocate, in bytes
+        dtype: The float type used to store the kernel
+        distances: Optional precomputed squared distances from the test to the train examples
+
+    Returns:
+        The predicted labels for each message
+    """
     M, N = matrix.shape
 
-    Xtrain = state['Xtrain']
+    # Contiguous word columns for packed_dot
+    Xtrain = np.asfortranarray(state['Xtrain'])
     Sqtrain = state['Sqtrain']
-    matrix = 1. * (matrix > 0)
-    squared = np.sum(matrix * matrix, axis=1)
-    gram = matrix.dot(Xtrain.T)
-    K = np.exp(-(squared.reshape((-1, 1)) + Sqtrain.reshape((1, -1)) - 2 * gram) / (2 * (radius ** 2)))
     alpha_avg = state['alpha_avg']
-    preds = K.dot(alpha_avg)
+    if distances is None:
+        matrix = pack_binary(matrix, max_memory)
+        squared = popcount(matrix).sum(axis=1)
+
+    preds = np.zeros(M)
+    itemsize = np.dtype(dtype).itemsize + (0 if distances is not None else PACKED_DOT_TEMP_BYTES)
+    blocks = list(row_blocks(M, Xtrain.shape[0], itemsize, max_memory))
+    # One kernel buffer is reused by every block
+    buffer = np.empty((blocks[0].stop - blocks[0].start if blocks else 0, Xtrain.shape[0]), dtype=dtype)
+    for rows in blocks:
+        K = buffer[:rows.stop - rows.start]
+        if distances is not None:
+            preds[rows] = rbf_decisions(distances[rows], radius, alpha_avg, out=K)
+        else:
+            sq_distances(matrix[rows], squared[rows], Xtrain, Sqtrain, out=K, dtype=dtype)
+            preds[rows] = rbf_decisions(K, radius, alpha_avg, out=K)
+    output = (1 + np.sign(preds)) // 2
+
+    return output
+
+
+def random_fourier_features(matrix, W, b, max_memory=MAX_KERNEL_BYTES):
+    """Map the binarized rows of matrix to z(x) = sqrt(2 / D) * cos(x.W + b).
+
+    Args:
+        matrix: A numpy array or scipy.sparse matrix of word counts, of shape (m, n)
+        W: Random projection of shape (n, D)
+        b: Random phases of shape (D,)
+        max_memory: The largest block of binarized rows to allocate, in bytes
+
+    Returns:
+        The (m, D) feature matrix, with the dtype of W
+    """
+    M, N = matrix.shape
+    D = W.shape[1]
+    Z = np.empty((M, D), dtype=W.dtype)
+    for rows in row_blocks(M, max(N, D), W.itemsize, max_memory):
+        Z[rows] = (matrix[rows] != 0).astype(W.dtype).dot(W)
+    Z += b
+    np.cos(Z, out=Z)
+    Z *= np.sqrt(2. / D)
+    return Z
+
+
+def rff_train(matrix, category, radius, n_components=1000, max_memory=MAX_KERNEL_BYTES,
+              dtype=np.float64, rng=None, batch_size=32, tol=1e-3, reg=1e-4):
+    """Train a linear SVM on random Fourier features approximating the RBF kernel.
+
+    Since E[z(x).z(y)] = exp(-|x - y|^2 / (2 radius^2)) for W ~ N(0, 1 / radius^2)
+    and b ~ U(0, 2 pi), a linear model on z(x) approximates the kernel SVM
+    with O(n_components) memory and prediction cost.
+
+    The features have norm ~1 and mostly share a large common component, so
+    the model is fit on centered features with an unregularized intercept,
+    using Pegasos steps 1 / (reg * t), offset by 100 steps so the first few
+    batches cannot pin the intercept to the majority class. The returned
+    model averages the last epoch's iterates; training stops with the same
+    probe rule as svm_train.
+
+    Args:
+        matrix: A numpy array or sparse matrix containing the word counts for the train set
+        category: The spam or not spam labels for the train set
+        radius: The RBF kernel radius to approximate
+        n_components: Number of random features D
+        max_memory: The largest block of binarized rows to allocate, in bytes
+        dtype: The float type used to store the features
+        rng: Random state used for the features and sampling (default: the global numpy one)
+        batch_size: Number of examples per gradient step
+        tol: Fraction of probe labels an epoch may flip and still count as settled
+        reg: L2 regularization strength of the hinge loss
+
+    Returns:
+        The model state used by rff_predict
+    """
+    state = {}
+    M, N = matrix.shape
+    Y = 2 * category - 1
+    rng = np.random if rng is None else rng
+    W = (rng.randn(N, n_components) / radius).astype(dtype)
+    b = (rng.rand(n_components) * 2 * np.pi).astype(dtype)
+    Z = random_fourier_features(matrix, W, b, max_memory)
+    Z_mean = Z.mean(axis=0)
+    Z -= Z_mean
+
+    theta = np.zeros(n_components)
+    intercept = 0.
+    outer_loops = 10
+    steps_per_loop = -(-M // batch_size)
+
+    probe = Z[probe_indices(M)]
+    settled = ProbeCheck(tol)
+    ii = 0
+    while ii < outer_loops * steps_per_loop:
+        if ii % steps_per_loop == 0:
+            theta_avg = np.zeros(n_components)
+            intercept_avg = 0.
+        idx = (rng.rand(batch_size) * M).astype(int)
+        Z_batch = Z[idx]
+        margins = Y[idx] * (Z_batch.dot(theta) + intercept)
+        coef = Y[idx] * (margins < 1) / batch_size
+        eta = 1. / (reg * (ii + 100))
+        theta *= 1 - eta * reg
+        theta += eta * Z_batch.T.dot(coef)
+        intercept += eta * coef.sum()
+        theta_avg += theta
+        intercept_avg += intercept
+        ii += 1
+
+        if ii % steps_per_loop == 0 and settled.update(probe.dot(theta_avg) + intercept_avg):
+            break
+
+    # Fold the centering into the intercept so rff_predict works on raw features
+    theta_avg /= steps_per_loop
+    intercept_avg /= steps_per_loop
+    state['W'] = W
+    state['b'] = b
+    state['theta'] = theta
+    state['theta_avg'] = theta_avg
+    state['intercept'] = intercept_avg - Z_mean.dot(theta_avg)
+    return state
+
+
+def rff_predict(state, matrix, max_memory=MAX_KERNEL_BYTES):
+    """Predict labels with a model trained by rff_train.
+
+    Args:
+        state: The model state returned by rff_train
+        matrix: A numpy array or sparse matrix containing the word counts for the test set
+        max_memory: The largest block of binarized rows to allocate, in bytes
+
+    Returns:
+        The predicted labels for each message
+    """
+    Z = random_fourier_features(matrix, state['W'], state['b'], max_memory)
+    preds = Z.dot(state['theta_avg']) + state['intercept']
     output = (1 + np.sign(preds)) // 2
 
     return output
@@ -1,4 +1,6 @@
 import csv
+import io
+import os
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -74,6 +76,51 @@ def load_spam_dataset(tsv_path):
 
     return messages, np.array(labels)
 
+def spam_tsv_shards(tsv_path, shard_size=64 * 1024 ** 2):
+    """Split a TSV file into byte ranges of about shard_size that hold whole lines.
+
+    Shards are cut at line starts, so a quoted field spanning a line break is
+    only parsed as one message if it does not straddle two shards.
+
+    Args:
+         tsv_path: Path to TSV file containing dataset.
+         shard_size: Approximate number of bytes per shard.
+
+    Returns:
+        A list of (start, end) byte offsets covering the file.
+    """
+    size = os.path.getsize(tsv_path)
+    bounds = [0]
+    with open(tsv_path, 'rb') as tsv_file:
+        for offset in range(shard_size, size, shard_size):
+            # Move to the first line starting at or after offset
+            tsv_file.seek(offset - 1)
+            tsv_file.readline()
+            if bounds[-1] < tsv_file.tell() < size:
+                bounds.append(tsv_file.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+def iter_spam_tsv(tsv_path, start=0, end=None):
+    """Iterate over the (message, label) pairs of a byte range of a spam TSV file.
+
+    Args:
+         tsv_path: Path to TSV file containing dataset.
+         start: Offset of the first byte, at the start of a line.
+         end: Offset past the last byte, at the end of a line (default: end of file).
+
+    Yields:
+        message: The text of a message.
+        label: 1 if the message is spam, 0 otherwise.
+    """
+    with open(tsv_path, 'rb') as tsv_file:
+        tsv_file.seek(start)
+        data = tsv_file.read() if end is None else tsv_file.read(end - start)
+
+    reader = csv.reader(io.StringIO(data.decode('utf8'), newline=''), delimiter='\t')
+    for label, message in reader:
+        yield message, 1 if label == 'spam' else 0
+
 def plot(x, y, theta, save_path, correction=1.0):
     """Plot dataset and fitted logistic regression parameters.
 
@@ -1,15 +1,18 @@
+import itertools
 import matplotlib.pyplot as plt
+import multiprocessing
 import numpy as np
 import os
 import sys
-
-from numpy.linalg import inv 
-from numpy.linalg import det
+import time
 
 PLOT_COLORS = ['red', 'green', 'blue', 'orange']  # Colors for your plots
 K = 4           # Number of Gaussians in the mixture model
 NUM_TRIALS = 3  # Number of trials to run (can be adjusted for debugging)
 UNLABELED = -1  # Cluster label for unlabeled data points (do not change)
+# Shapes of sigma for each covariance type: full (k, n, n), diag (k, n),
+# tied (n, n) shared by all components, spherical (k,) variances
+COVARIANCE_TYPES = ('full', 'diag', 'tied', 'spherical')
 
 
 def main(is_semi_supervised, trial_num):
@@ -32,31 +35,19 @@ def main(is_semi_supervised, trial_num):
     # *** START CODE HERE ***
     # (1) Initialize mu and sigma by splitting the m data points uniformly at random
     # into K groups, then calculating the sample mean and covariance for each group
-
-    # create k splits after shuffling data
-    x_shuffled = np.copy(x)
-    np.random.shuffle(x_shuffled)
-    k_splits = np.array_split(x_shuffled,K)
-
-    # calculate sample mean and covariance
+    # (2) Initialize phi to place equal probability on each Gaussian
+    # phi should be a numpy array of shape (K,)
     m,n = x.shape
-    mu = []
-    sigma = []
-    for i in range(K):
-        mu.append(np.average(k_splits[i],axis=0)) 
-        sigma.append(np.cov(k_splits[i].T))
-    
+    phi, mu, sigma = init_params(x, K)
+
     assert(len(mu) == K)
     assert(mu[0].shape == (n,))
-    
+
     assert(len(sigma) == K)
     assert(sigma[0].shape == (n,n))
-    
-    # (2) Initialize phi to place equal probability on each Gaussian
-    # phi should be a numpy array of shape (K,)
-    phi = np.ones(K)/K
-    assert(phi.shape == (K,)) 
-    
+
+    assert(phi.shape == (K,))
+
     # (3) Initialize the w values to place equal probability on each Gaussian
     # w should be a numpy array of shape (m, K)
     w = np.ones((m,K))/K
@@ -72,8 +63,7 @@ def main(is_semi_supervised, trial_num):
     # Plot your predictions
     z_pred = np.zeros(m)
     if w is not None:  # Just a placeholder for the starter code
-        for i in range(m):
-            z_pred[i] = np.argmax(w[i])
+        z_pred = np.argmax(w, axis=1)
 
     plot_gmm_preds(x, z_pred, is_semi_supervised, plot_id=trial_num)
 
@@ -99,61 +89,65 @@ def run_em(x, w, phi, mu, sigma):
     eps = 1e-3  # Convergence threshold
     max_iter = 1000
 
+    # *** START CODE HERE
+    w = fit_em(x, phi, mu, sigma, eps, max_iter)[0]
+    # *** END CODE HERE ***
+    return w
+
+
+def fit_em(x, phi, mu, sigma, eps=1e-3, max_iter=1000, verbose=True, covariance_type='full'):
+    """Run unsupervised EM from the given parameters until convergence.
+
+    Args:
+        x: Design matrix of shape (m, n).
+        phi: Initial mixture prior, of shape (k,).
+        mu: Initial cluster means, list of k arrays of shape (n,).
+        sigma: Initial cluster covariances in the shape of `covariance_type`.
+        eps: Convergence threshold on the change in log-likelihood.
+        max_iter: Maximum number of iterations.
+        verbose: Print the log-likelihood at every iteration.
+        covariance_type: One of COVARIANCE_TYPES.
+
+    Returns:
+        w: Weight matrix of shape (m, k) from the last E-step.
+        phi, mu, sigma: Fitted parameters, as arrays.
+        ll: Log-likelihood at the last E-step.
+        it: Number of iterations run.
+    """
     # Stop when the absolute change in log-likelihood is < eps
     # See below for explanation of the convergence criterion
     it = 0
     ll = prev_ll = None
     m,n = x.shape
+    k = len(phi)
+    mu = np.array(mu)
+    sigma = np.array(sigma)
 
     while it < max_iter and (prev_ll is None or np.abs(ll - prev_ll) >= eps):
-        # Just a placeholder for the starter code
-        # *** START CODE HERE
-        
         prev_ll = ll
 
         # (1) E-step: Update your estimates in w
-        w_den = 0
-
-        for i in range(m):
-            for j in range(K):
-                v = (x[i]-mu[j])
-                # p(z|x) estimation for EM                
-                w[i,j] = det(sigma[j])**(-1/2)*np.exp(-1/2*v.T@inv(sigma[j])@v)*phi[j]
-                w_den += w[i,j]
-            # divide i row by w_den, reset w_den sum for next example
-            w[i:] /= w_den
-            w_den = 0
+        # (3) Compute the log-likelihood of the data to check for convergence.
+        # By log-likelihood, we mean `ll = sum_x[log(sum_z[p(x|z) * p(z)])]`.
+        # Both come from the same log p(x|z) + log p(z) matrix, so the log-likelihood
+        # is that of the parameters before this iteration's M-step.
+        # We define convergence by the first iteration where abs(ll - prev_ll) < eps.
+        # Hint: For debugging, recall part (a). We showed that ll should be monotonically increasing.
+        w, ll = e_step(x, phi, mu, sigma, covariance_type)
 
         # (2) M-step: Update the model parameters phi, mu, and sigma
         phi = np.sum(w,axis=0)/m
-        assert(phi.shape == (K,))
+        assert(phi.shape == (k,))
 
-        for l in range(K):
+        for l in range(k):
             mu[l] = (x.T@w[:,l])/np.sum(w[:,l])
-     
-        for l in range(K):
-            sigma[l] = (x-mu[l]).T@((x-mu[l])*w[:,l].reshape(m,1))
-            sigma[l] /= np.sum(w[:,l])
-            assert(sigma[l].shape == (n,n))
 
-        # (3) Compute the log-likelihood of the data to check for convergence.
-        # By log-likelihood, we mean `ll = sum_x[log(sum_z[p(x|z) * p(z)])]`.
-        # We define convergence by the first iteration where abs(ll - prev_ll) < eps.
-        # Hint: For debugging, recall part (a). We showed that ll should be monotonically increasing.
-        
-        sum_z = 0
-        sum_x = 0
-        for i in range(m):
-            for l in range(K):
-                nconst = 1/((2*np.pi)**(n/2)*det(sigma[l])**(1/2))
-                v = (x[i]-mu[l])
-                sum_z += nconst*np.exp(-1/2*v.T@inv(sigma[l])@v)*phi[l]
-            sum_x += np.log(sum_z)
-        ll = sum_x
+        sigma = update_covariance(x, w, mu, covariance_type)
 
-        # *** END CODE HERE ***
-        print(ll)
-    return w
+        it += 1
+        if verbose:
+            print(ll)
+    return w, phi, mu, sigma, ll, it
 
 
 def run_semi_supervised_em(x, x_tilde, z, w, phi, mu, sigma):
@@ -184,25 +178,636 @@ def run_semi_supervised_em(x, x_tilde, z, w, phi, mu, sigma):
     # See below for explanation of the convergence criterion
     it = 0
     ll = prev_ll = None
+    m,n = x.shape
+    k = w.shape[1]
+    mu = np.array(mu)
+    sigma = np.array(sigma)
+
+    # The labeled examples have fixed one-hot weights alpha, so their counts, sums
+    # and outer-product sums per class are computed once and reused every iteration
+    counts, sums, outer = labeled_stats(x_tilde, z, k, alpha)
+
     while it < max_iter and (prev_ll is None or np.abs(ll - prev_ll) >= eps):
-        pass  # Just a placeholder for the starter code
         # *** START CODE HERE ***
+        prev_ll = ll
+
         # (1) E-step: Update your estimates in w
-        
-        # (2) M-step: Update the model parameters phi, mu, and sigma
-        
         # (3) Compute the log-likelihood of the data to check for convergence.
-        
-        # Hint: Make sure to include alpha in your calculation of ll.
+        # The labeled term alpha * sum_i log p(x_tilde^(i), z^(i)) comes from the
+        # precomputed statistics, so only the unlabeled examples are visited.
         # Hint: For debugging, recall part (a). We showed that ll should be monotonically increasing.
-        
+        w, ll = e_step(x, phi, mu, sigma)
+        ll += labeled_log_likelihood(counts, sums, outer, phi, mu, sigma)
+
+        # (2) M-step: Update the model parameters phi, mu, and sigma
+        n_k = np.sum(w,axis=0) + counts
+        phi = n_k/np.sum(n_k)
+        assert(phi.shape == (k,))
+
+        mu = (w.T@x + sums)/n_k.reshape(k,1)
+
+        sigma = centered_outer(counts, sums, outer, mu)
+        for l in range(k):
+            sigma[l] += (x-mu[l]).T@((x-mu[l])*w[:,l].reshape(m,1))
+        sigma /= n_k.reshape(k,1,1)
+
+        it += 1
         # *** END CODE HERE ***
+        print(ll)
 
     return w
 
 
 # *** START CODE HERE ***
 # Helper functions
+class GMM(object):
+    """A fitted Gaussian mixture model."""
+
+    def __init__(self, phi, mu, sigma, covariance_type='full'):
+        """
+        Args:
+            phi: Mixture prior, of shape (k,).
+            mu: Cluster means, of shape (k, n).
+            sigma: Cluster covariances in the shape of covariance_type.
+            covariance_type: One of COVARIANCE_TYPES.
+        """
+        self.phi = np.asarray(phi)
+        self.mu = np.asarray(mu)
+        self.sigma = np.asarray(sigma)
+        self.covariance_type = covariance_type
+
+    @classmethod
+    def from_fit(cls, fit, covariance_type='full'):
+        """Build a model from a fit returned by multi_restart_em or select_num_components."""
+        return cls(fit['phi'], fit['mu'], fit['sigma'], covariance_type)
+
+    def predict_proba(self, x, chunk_size=65536):
+        """Posterior probability of each component, of shape (m, k).
+
+        Examples are processed in chunks of `chunk_size` rows, which bounds the
+        memory of the (k, chunk_size, n) intermediate of log_gaussian.
+        """
+        return np.concatenate([self._e_step(x[i:i + chunk_size])[0]
+                               for i in range(0, max(len(x), 1), chunk_size)])
+
+    def predict(self, x, chunk_size=65536):
+        """Index of the most likely component for each example, of shape (m,)."""
+        return np.argmax(self.predict_proba(x, chunk_size), axis=1)
+
+    def log_likelihood(self, x, chunk_size=65536):
+        """Log-likelihood sum_i log p(x^(i)) of the examples."""
+        return sum(self._e_step(x[i:i + chunk_size])[1] for i in range(0, len(x), chunk_size))
+
+    def _e_step(self, x):
+        return e_step(x, self.phi, self.mu, self.sigma, self.covariance_type)
+
+
+def online_em(batches, k=K, forget=0.05, stats=None, reg=1e-6, rng=np.random, verbose=True):
+    """Stepwise online EM over a stream of mini-batches.
+
+    Instead of the full weight matrix, the model keeps running averages of the
+    sufficient statistics of the mixture: the mean of w[:, j], of w[:, j] x and
+    of w[:, j] x x^T. Each batch runs an E-step with the current parameters and
+    moves the averages towards the batch's statistics with step size
+    rho_t = max(forget, 1 / t), so the first batches are averaged equally and
+    later ones are weighted exponentially. The parameters are then read off
+    the averages. Memory depends on the batch size, not on the number of
+    examples, and a constant `forget` lets the model follow slowly drifting data.
+
+    Args:
+        batches: Iterable of design matrices of shape (batch_size, n), e.g. the
+            x of each chunk from iter_gmm_dataset.
+        k: Number of Gaussians.
+        forget: Smallest step size, i.e. the weight of the newest batch once
+            1 / t drops below it.
+        stats: Statistics returned by a previous call, to continue fitting.
+            If None, the parameters are initialized from the first batch.
+        reg: Value added to the diagonal of each covariance.
+        rng: Random number generator for the initialization.
+        verbose: Print the average log-likelihood of each batch before its update.
+
+    Returns:
+        phi: Mixture prior, of shape (k,).
+        mu: Cluster means, of shape (k, n).
+        sigma: Cluster covariances, of shape (k, n, n).
+        stats: Tuple (t, s0, s1, s2) of the batch count and running averages.
+    """
+    for x in batches:
+        if stats is None:
+            phi, mu, sigma = init_params(x, k, rng)
+            mu, sigma = np.array(mu), np.array(sigma)
+            n = x.shape[1]
+            stats = (0, np.zeros(k), np.zeros((k, n)), np.zeros((k, n, n)))
+        else:
+            phi, mu, sigma = stats_to_params(stats, reg)
+        t, s0, s1, s2 = stats
+
+        w, ll = e_step(x, phi, mu, sigma)
+        if verbose:
+            print(ll / len(x))
+
+        t += 1
+        rho = max(forget, 1. / t)
+        s0 = (1 - rho) * s0 + rho * np.mean(w, axis=0)
+        s1 = (1 - rho) * s1 + rho * (w.T @ x) / len(x)
+        s2 = (1 - rho) * s2 + rho * np.einsum('ik,ia,ib->kab', w, x, x) / len(x)
+        stats = (t, s0, s1, s2)
+
+    phi, mu, sigma = stats_to_params(stats, reg)
+    return phi, mu, sigma, stats
+
+
+def stats_to_params(stats, reg=1e-6):
+    """Read phi, mu and sigma off the running averages of online_em."""
+    _, s0, s1, s2 = stats
+    phi = s0/np.sum(s0)
+    mu = s1/s0.reshape(-1,1)
+    sigma = s2/s0.reshape(-1,1,1) - mu[:, :, None] * mu[:, None, :]
+    sigma += reg * np.eye(mu.shape[1])
+    return phi, mu, sigma
+
+
+def init_params(x, k, rng=np.random, covariance_type='full', init='random', kmeans_iter=10):
+    """Initialize the parameters from k groups of the examples.
+
+    With init='random' the groups are a random split of the examples, which
+    gives nearly identical components. 'kmeans++' groups the examples by their
+    nearest k-means++ seed, and 'kmeans' additionally refines the seeds with up
+    to `kmeans_iter` iterations of k-means. Both start EM with components that
+    are already apart, and phi is then the fraction of examples in each group.
+
+    Args:
+        x: Design matrix of shape (m, n).
+        k: Number of Gaussians.
+        rng: Random number generator, np.random or a np.random.RandomState.
+        covariance_type: One of COVARIANCE_TYPES.
+        init: One of 'random', 'kmeans++' or 'kmeans'.
+        kmeans_iter: Maximum number of k-means iterations for init='kmeans'.
+
+    Returns:
+        phi: Mixture prior, of shape (k,).
+        mu: Sample means of the groups, list of k arrays of shape (n,).
+        sigma: Sample covariances of the groups, a list of k arrays of shape
+            (n, n) for 'full', otherwise an array in the shape of covariance_type.
+    """
+    if init in ('kmeans++', 'kmeans'):
+        centroids = kmeans_plus_plus(x, k, rng)
+        centroids, labels = kmeans(x, centroids, kmeans_iter if init == 'kmeans' else 0)
+        w = (labels[:, None] == np.arange(k)).astype(float)
+        if not np.all(np.any(w, axis=0)):
+            raise ValueError('{} initialization left a component without examples; '
+                             'x may have fewer than k={} distinct examples'.format(init, k))
+        phi = np.mean(w, axis=0)
+        mu = (w.T@x)/np.sum(w,axis=0).reshape(k,1)
+        sigma = update_covariance(x, w, mu, covariance_type)
+        # Keep single-example groups from starting with a singular covariance
+        sigma += 1e-6 * (np.eye(x.shape[1]) if covariance_type in ('full', 'tied') else 1)
+        return phi, list(mu), list(sigma) if covariance_type == 'full' else sigma
+    elif init != 'random':
+        raise ValueError('Unknown initialization: {}'.format(init))
+
+    # create k splits after shuffling data
+    x_shuffled = np.copy(x)
+    rng.shuffle(x_shuffled)
+    k_splits = np.array_split(x_shuffled,k)
+
+    # calculate sample mean and covariance
+    mu = [np.average(split,axis=0) for split in k_splits]
+    sigma = [np.cov(split.T) for split in k_splits]
+    phi = np.ones(k)/k
+    if covariance_type != 'full':
+        sigma = reduce_covariance(np.array(sigma), phi, covariance_type)
+    return phi, mu, sigma
+
+
+def kmeans_plus_plus(x, k, rng=np.random):
+    """Choose k seeds among the examples by k-means++ (D^2) sampling.
+
+    Once every example coincides with a seed (fewer than k distinct
+    examples), the remaining seeds are drawn uniformly, so seeds repeat.
+
+    Args:
+        x: Design matrix of shape (m, n).
+        k: Number of seeds.
+        rng: Random number generator, np.random or a np.random.RandomState.
+
+    Returns:
+        Array of shape (k, n) of seeds.
+    """
+    m = x.shape[0]
+    idxs = [rng.randint(m)]
+    sq_dists = np.sum((x - x[idxs[0]]) ** 2, axis=1)
+    for _ in range(1, k):
+        # Each example is picked with probability proportional to its squared
+        # distance to the closest seed so far
+        total = np.sum(sq_dists)
+        idxs.append(rng.choice(m, p=sq_dists / total) if total > 0 else rng.randint(m))
+        sq_dists = np.minimum(sq_dists, np.sum((x - x[idxs[-1]]) ** 2, axis=1))
+    return x[idxs]
+
+
+def kmeans(x, centroids, max_iter=10):
+    """Run k-means from the given centroids until the assignments stop changing.
+
+    Args:
+        x: Design matrix of shape (m, n).
+        centroids: Initial centroids, of shape (k, n).
+        max_iter: Maximum number of centroid updates.
+
+    Returns:
+        centroids: Final centroids, of shape (k, n).
+        labels: Index of the closest final centroid for each example, shape (m,).
+    """
+    k = centroids.shape[0]
+    sq_x = np.sum(x ** 2, axis=1)
+    labels = None
+    for it in range(max_iter + 1):
+        # |x - c|^2 = |x|^2 - 2 x.c + |c|^2 for all pairs at once
+        sq_dists = sq_x[:, None] - 2 * x@centroids.T + np.sum(centroids ** 2, axis=1)
+        new_labels = np.argmin(sq_dists, axis=1)
+        if it == max_iter or (labels is not None and np.array_equal(labels, new_labels)):
+            return centroids, new_labels
+        labels = new_labels
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, x)
+        # Empty clusters keep their centroid
+        nonempty = counts > 0
+        centroids = centroids.copy()
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+
+
+def reduce_covariance(sigma, phi, covariance_type):
+    """Convert full covariances of shape (k, n, n) to the shape of covariance_type."""
+    if covariance_type == 'full':
+        return sigma
+    variances = np.diagonal(sigma, axis1=1, axis2=2)
+    if covariance_type == 'diag':
+        return variances.copy()
+    if covariance_type == 'tied':
+        return np.tensordot(phi, sigma, axes=1)
+    if covariance_type == 'spherical':
+        return np.mean(variances, axis=1)
+    raise ValueError('Unknown covariance type: {}'.format(covariance_type))
+
+
+def update_covariance(x, w, mu, covariance_type='full'):
+    """M-step update of the covariances for the given weights and new means.
+
+    Only the full and tied types form n x n matrices; the diagonal and
+    spherical types need just the weighted squared deviations of each
+    feature. All moments are taken about the component means, since
+    uncentered ones (E[x^2] - mu^2) lose all precision when the data lies
+    far from the origin.
+
+    Args:
+        x: Design matrix of shape (m, n).
+        w: Weight matrix of shape (m, k).
+        mu: Updated cluster means, array of shape (k, n).
+        covariance_type: One of COVARIANCE_TYPES.
+
+    Returns:
+        Covariances in the shape of covariance_type.
+    """
+    m,n = x.shape
+    k = mu.shape[0]
+    n_k = np.sum(w,axis=0)
+    if covariance_type == 'full':
+        sigma = np.empty((k,n,n))
+        for l in range(k):
+            sigma[l] = (x-mu[l]).T@((x-mu[l])*w[:,l].reshape(m,1))
+            sigma[l] /= n_k[l]
+        return sigma
+    if covariance_type == 'tied':
+        # sum_j sum_i w_ij (x - mu_j)(x - mu_j)^T / m
+        sigma = np.zeros((n,n))
+        for l in range(k):
+            sigma += (x-mu[l]).T@((x-mu[l])*w[:,l].reshape(m,1))
+        return sigma/m
+    # E_j[(x_a - mu_ja)^2] for each component and feature
+    variances = np.empty((k,n))
+    for l in range(k):
+        variances[l] = w[:,l]@((x-mu[l])**2)/n_k[l]
+    if covariance_type == 'diag':
+        return variances
+    if covariance_type == 'spherical':
+        return np.mean(variances, axis=1)
+    raise ValueError('Unknown covariance type: {}'.format(covariance_type))
+
+
+def multi_restart_em(x, k=K, num_trials=NUM_TRIALS, seed=229, n_jobs=None, eps=1e-3, max_iter=1000,
+                     covariance_type='full', init='random'):
+    """Fit EM from several random initializations in parallel and keep the best.
+
+    The trials run in a process pool. The design matrix is copied once into
+    shared memory that the workers read in place, and each trial draws its
+    initialization from its own RandomState, seeded from `seed`.
+
+    Args:
+        x: Design matrix of shape (m, n).
+        k: Number of Gaussians.
+        num_trials: Number of random initializations.
+        seed: Seed for the per-trial seeds.
+        n_jobs: Number of worker processes (default: one per CPU, at most num_trials).
+        eps: Convergence threshold on the change in log-likelihood.
+        max_iter: Maximum number of iterations per trial.
+        covariance_type: One of COVARIANCE_TYPES.
+        init: Initialization method of init_params.
+
+    Returns:
+        best: The trial with the highest final log-likelihood, plus its weight
+            matrix of shape (m, k) under 'w'.
+        trials: One dict per trial, in seed order, with keys 'seed', 'll',
+            'iterations', 'seconds', 'phi', 'mu' and 'sigma'. A trial in which a
+            component collapsed onto too few examples for a positive definite
+            covariance has ll -inf and None parameters.
+    """
+    x = np.asarray(x, dtype=float)
+    seeds = np.random.RandomState(seed).randint(2 ** 31 - 1, size=num_trials)
+    trials = _run_trials(x, [(s, k, eps, max_iter, covariance_type, init) for s in seeds], n_jobs)
+
+    best = _best_trial(trials)
+    best['w'] = e_step(x, best['phi'], best['mu'], best['sigma'], covariance_type)[0]
+    return best, trials
+
+
+def select_num_components(x, ks=range(1, 9), criterion='bic', num_trials=NUM_TRIALS, seed=229, n_jobs=None,
+                          eps=1e-3, max_iter=1000, covariance_type='full', init='random', warm_start=False):
+    """Fit mixtures with each number of components in ks and score them with BIC and AIC.
+
+    Without warm starts, every (k, restart) pair is an independent EM run and
+    they all run concurrently in one process pool sharing x, as in
+    multi_restart_em. With warm_start=True, only the smallest k is fit from
+    random restarts. Each larger k then starts from the previous solution with
+    its widest components split in two (see split_component), so the sweep
+    runs as a chain in this process.
+
+    BIC = -2 ll + p log(m) and AIC = -2 ll + 2 p, where p is the number of
+    free parameters (num_parameters). Lower is better for both.
+
+    Args:
+        x: Design matrix of shape (m, n).
+        ks: Numbers of Gaussians to try.
+        criterion: 'bic' or 'aic', the score used to pick the best model.
+        num_trials: Number of random initializations per k (for the smallest k
+            only with warm_start).
+        seed: Seed for the per-trial seeds.
+        n_jobs: Number of worker processes (default: one per CPU).
+        eps: Convergence threshold on the change in log-likelihood.
+        max_iter: Maximum number of iterations per fit.
+        covariance_type: One of COVARIANCE_TYPES.
+        init: Initialization method of init_params.
+        warm_start: Initialize each k from the solution of the previous one.
+
+    Returns:
+        best: The best fit under `criterion`, with the keys of a
+            multi_restart_em trial plus 'k', 'num_params', 'bic', 'aic' and
+            its weight matrix under 'w'.
+        table: One dict per k, in increasing k, with keys 'k', 'll',
+            'num_params', 'bic', 'aic', 'iterations' and 'seconds' of the best
+            fit for that k.
+    """
+    if criterion not in ('bic', 'aic'):
+        raise ValueError('Unknown criterion: {}'.format(criterion))
+    x = np.asarray(x, dtype=float)
+    m, n = x.shape
+    ks = sorted(ks)
+    seeds = np.random.RandomState(seed).randint(2 ** 31 - 1, size=num_trials)
+
+    if warm_start:
+        trials = _run_trials(x, [(s, ks[0], eps, max_iter, covariance_type, init) for s in seeds], n_jobs)
+        fits = [_best_trial(trials)]
+        for k in ks[1:]:
+            start = time.time()
+            phi, mu, sigma = fits[-1]['phi'], fits[-1]['mu'], fits[-1]['sigma']
+            while len(phi) < k:
+                phi, mu, sigma = split_component(phi, mu, sigma, covariance_type)
+            _, phi, mu, sigma, ll, it = fit_em(x, phi, mu, sigma, eps, max_iter, verbose=False,
+                                               covariance_type=covariance_type)
+            fits.append({'seed': None, 'k': k, 'll': ll, 'iterations': it, 'seconds': time.time() - start,
+                         'phi': phi, 'mu': mu, 'sigma': sigma})
+    else:
+        tasks = [(s, k, eps, max_iter, covariance_type, init) for k in ks for s in seeds]
+        trials = _run_trials(x, tasks, n_jobs)
+        fits = [_best_trial(trials[i:i + num_trials]) for i in range(0, len(trials), num_trials)]
+
+    table = []
+    for fit in fits:
+        p = num_parameters(fit['k'], n, covariance_type)
+        fit.update(num_params=p, bic=-2 * fit['ll'] + p * np.log(m), aic=-2 * fit['ll'] + 2 * p)
+        table.append({key: fit[key] for key in ('k', 'll', 'num_params', 'bic', 'aic', 'iterations', 'seconds')})
+
+    best = dict(min(fits, key=lambda fit: fit[criterion]))
+    best['w'] = e_step(x, best['phi'], best['mu'], best['sigma'], covariance_type)[0]
+    return best, table
+
+
+def num_parameters(k, n, covariance_type='full'):
+    """Number of free parameters of a mixture of k Gaussians in n dimensions."""
+    covariance_params = {
+        'full': k * n * (n + 1) // 2,
+        'diag': k * n,
+        'tied': n * (n + 1) // 2,
+        'spherical': k,
+    }[covariance_type]
+    return (k - 1) + k * n + covariance_params
+
+
+def split_component(phi, mu, sigma, covariance_type='full'):
+    """Split the component with the largest phi_j * tr(sigma_j) in two.
+
+    The halves share its covariance and half its weight, and their means are
+    moved one standard deviation apart along its principal axis.
+
+    Returns:
+        phi, mu, sigma with one more component.
+    """
+    mu = np.asarray(mu)
+    k, n = mu.shape
+    if covariance_type == 'full':
+        covs = np.asarray(sigma)
+    elif covariance_type == 'diag':
+        covs = sigma[:, :, None] * np.eye(n)
+    elif covariance_type == 'tied':
+        covs = np.broadcast_to(sigma, (k, n, n))
+    else:
+        covs = sigma[:, None, None] * np.eye(n)
+    j = np.argmax(phi * np.trace(covs, axis1=1, axis2=2))
+    eigvals, eigvecs = np.linalg.eigh(covs[j])
+    offset = np.sqrt(eigvals[-1]) * eigvecs[:, -1]
+
+    phi = np.append(phi, phi[j] / 2)
+    phi[j] /= 2
+    mu = np.vstack([mu, mu[j] + offset])
+    mu[j] -= offset
+    if covariance_type != 'tied':
+        sigma = np.concatenate([sigma, sigma[j:j + 1]])
+    return phi, mu, sigma
+
+
+def _run_trials(x, tasks, n_jobs=None):
+    """Run _restart_trial on each task tuple in a process pool sharing x."""
+    shared_x = multiprocessing.RawArray('d', x.size)
+    np.frombuffer(shared_x).reshape(x.shape)[:] = x
+
+    n_jobs = min(n_jobs or multiprocessing.cpu_count(), len(tasks))
+    with multiprocessing.Pool(n_jobs, initializer=_init_restart_worker,
+                              initargs=(shared_x, x.shape)) as pool:
+        return pool.starmap(_restart_trial, tasks)
+
+
+def _best_trial(trials):
+    best = dict(max(trials, key=lambda trial: trial['ll']))
+    if best['phi'] is None:
+        raise np.linalg.LinAlgError('Every trial ended with a singular covariance')
+    return best
+
+
+def _init_restart_worker(shared_x, shape):
+    global _restart_x
+    _restart_x = np.frombuffer(shared_x).reshape(shape)
+
+
+def _restart_trial(seed, k, eps, max_iter, covariance_type, init):
+    start = time.time()
+    phi, mu, sigma = init_params(_restart_x, k, np.random.RandomState(seed), covariance_type, init)
+    try:
+        _, phi, mu, sigma, ll, it = fit_em(_restart_x, phi, mu, sigma, eps, max_iter, verbose=False,
+                                           covariance_type=covariance_type)
+    except np.linalg.LinAlgError:
+        phi = mu = sigma = None
+        ll, it = -np.inf, None
+    return {'seed': int(seed), 'k': k, 'll': ll, 'iterations': it, 'seconds': time.time() - start,
+            'phi': phi, 'mu': mu, 'sigma': sigma}
+
+
+def logsumexp(a, axis=None):
+    """Compute log(sum(exp(a))) along an axis without overflow or underflow."""
+    a_max = np.max(a, axis=axis, keepdims=True)
+    out = np.log(np.sum(np.exp(a - a_max), axis=axis, keepdims=True)) + a_max
+    return np.squeeze(out, axis=axis) if axis is not None else out.item()
+
+
+def log_gaussian(x, mu, sigma, covariance_type='full'):
+    """Log densities of every example under every Gaussian component.
+
+    Each covariance is factored once as sigma_j = L_j L_j^T. With P_j = L_j^{-1},
+    the Mahalanobis distance of x^(i) is |P_j (x^(i) - mu_j)|^2, computed for all
+    examples and components with one batched matrix product, and
+    log det(sigma_j) = 2 sum(log(diag(L_j))).
+
+    The other covariance types never factor per-component matrices: a tied
+    covariance is factored once and projects x once, and diagonal or spherical
+    distances expand as x^2 / s - 2 x mu / s + mu^2 / s, i.e. matrix products
+    of shape (m, n) x (n, k). The expansions are taken about the mean of the
+    component means, so they do not cancel catastrophically for data far
+    from the origin.
+
+    Args:
+        x: Design matrix of shape (m, n).
+        mu: Cluster means, array of shape (k, n).
+        sigma: Cluster covariances in the shape of covariance_type.
+        covariance_type: One of COVARIANCE_TYPES.
+
+    Returns:
+        Matrix of shape (m, k) with log N(x^(i); mu_j, sigma_j) in entry (i, j).
+    """
+    m, n = x.shape
+    if covariance_type != 'full':
+        center = np.mean(mu, axis=0)
+        x = x - center
+        mu = mu - center
+        if covariance_type == 'tied':
+            chol = np.linalg.cholesky(sigma)
+            prec_chol = np.linalg.inv(chol)
+            x_proj = x@prec_chol.T
+            mu_proj = mu@prec_chol.T
+            mahalanobis = (np.sum(x_proj ** 2, axis=1)[:, None] - 2 * x_proj@mu_proj.T
+                           + np.sum(mu_proj ** 2, axis=1))
+            log_det = 2 * np.sum(np.log(np.diag(chol)))
+        elif covariance_type in ('diag', 'spherical') and np.any(sigma <= 0):
+            # Match cholesky, which raises for a collapsed full covariance
+            raise np.linalg.LinAlgError('Variance is not positive')
+        elif covariance_type == 'diag':
+            prec = 1. / sigma
+            mahalanobis = (x ** 2)@prec.T - 2 * x@(mu * prec).T + np.sum(mu ** 2 * prec, axis=1)
+            log_det = np.sum(np.log(sigma), axis=1)
+        elif covariance_type == 'spherical':
+            mahalanobis = (np.sum(x ** 2, axis=1)[:, None] - 2 * x@mu.T
+                           + np.sum(mu ** 2, axis=1)) / sigma
+            log_det = n * np.log(sigma)
+        else:
+            raise ValueError('Unknown covariance type: {}'.format(covariance_type))
+        return -0.5 * (mahalanobis + log_det + n * np.log(2 * np.pi))
+
+    chol = np.linalg.cholesky(sigma)
+    prec_chol = np.linalg.inv(chol)
+    # (k, m, n): rows P_j (x^(i) - mu_j)
+    y = np.matmul(x[None] - mu[:, None], prec_chol.transpose(0, 2, 1))
+    mahalanobis = np.sum(y ** 2, axis=2).T
+    log_det = 2 * np.sum(np.log(np.diagonal(chol, axis1=1, axis2=2)), axis=1)
+    return -0.5 * (mahalanobis + log_det + n * np.log(2 * np.pi))
+
+
+def e_step(x, phi, mu, sigma, covariance_type='full'):
+    """Compute the posterior weights and the log-likelihood, in log space.
+
+    Args:
+        x: Design matrix of shape (m, n).
+        phi: Mixture prior, of shape (k,).
+        mu: Cluster means, array of shape (k, n).
+        sigma: Cluster covariances in the shape of covariance_type.
+        covariance_type: One of COVARIANCE_TYPES.
+
+    Returns:
+        w: Weight matrix of shape (m, k), w[i, j] = p(z^(i) = j | x^(i)).
+        ll: Log-likelihood sum_i log(sum_j p(x^(i) | z = j) p(z = j)).
+    """
+    log_joint = log_gaussian(x, mu, sigma, covariance_type) + np.log(phi)
+    log_px = logsumexp(log_joint, axis=1)
+    w = np.exp(log_joint - log_px[:, None])
+    return w, np.sum(log_px)
+
+
+def labeled_stats(x_tilde, z, k, alpha):
+    """Weighted sufficient statistics of the labeled examples for each class.
+
+    Args:
+        x_tilde: Design matrix of labeled examples of shape (m_tilde, n).
+        z: Array of labels of shape (m_tilde, 1).
+        k: Number of Gaussians.
+        alpha: Weight of each labeled example.
+
+    Returns:
+        counts: Weighted number of examples per class, shape (k,).
+        sums: Weighted sum of the examples per class, shape (k, n).
+        outer: Weighted sum of x x^T per class, shape (k, n, n).
+    """
+    one_hot = alpha * (z.reshape(-1).astype(int)[:, None] == np.arange(k))
+    counts = np.sum(one_hot, axis=0)
+    sums = one_hot.T @ x_tilde
+    outer = np.einsum('ik,ia,ib->kab', one_hot, x_tilde, x_tilde)
+    return counts, sums, outer
+
+
+def centered_outer(counts, sums, outer, mu):
+    """Turn weighted sums of x x^T into sums of (x - mu_j)(x - mu_j)^T for each class."""
+    mu_sums = mu[:, :, None] * sums[:, None, :]
+    return outer - mu_sums - mu_sums.transpose(0, 2, 1) + counts[:, None, None] * mu[:, :, None] * mu[:, None, :]
+
+
+def labeled_log_likelihood(counts, sums, outer, phi, mu, sigma):
+    """Weighted log-likelihood sum_i log p(x_tilde^(i), z^(i)) from the labeled statistics.
+
+    sum_i (x - mu_j)^T sigma_j^{-1} (x - mu_j) over class j equals
+    tr(sigma_j^{-1} S_j) with S_j the centered scatter matrix, so the cost
+    does not depend on the number of labeled examples.
+    """
+    n = mu.shape[1]
+    chol = np.linalg.cholesky(sigma)
+    log_det = 2 * np.sum(np.log(np.diagonal(chol, axis1=1, axis2=2)), axis=1)
+    quad = np.einsum('kab,kab->k', np.linalg.inv(sigma), centered_outer(counts, sums, outer, mu))
+    return np.sum(-0.5 * quad - 0.5 * counts * (log_det + n * np.log(2 * np.pi)) + counts * np.log(phi))
 # *** END CODE HERE ***
 
 
@@ -219,10 +824,13 @@ def plot_gmm_preds(x, z, with_supervision, plot_id):
     plt.xlabel('x_1')
     plt.ylabel('x_2')
 
-    for x_1, x_2, z_ in zip(x[:, 0], x[:, 1], z):
+    # One scatter call per label rather than per point
+    z = np.asarray(z).reshape(-1)
+    for z_ in np.unique(z):
         color = 'gray' if z_ < 0 else PLOT_COLORS[int(z_)]
         alpha = 0.25 if z_ < 0 else 0.75
-        plt.scatter(x_1, x_2, marker='.', c=color, alpha=alpha)
+        in_group = z == z_
+        plt.scatter(x[in_group, 0], x[in_group, 1], marker='.', c=color, alpha=alpha)
 
     file_name = 'p03_pred{}_{}.pdf'.format('_ss' if with_supervision else '', plot_id)
     save_path = os.path.join('output', file_name)
@@ -247,8 +855,7 @@ def load_gmm_dataset(csv_path):
         headers = csv_fh.readline().strip().split(',')
 
     # Load features and labels
-    x_cols = [i for i in range(len(headers)) if headers[i].startswith('x')]
-    z_cols = [i for i in range(len(headers)) if headers[i] == 'z']
+    x_cols, z_cols = gmm_columns(headers)
 
     x = np.loadtxt(csv_path, delimiter=',', skiprows=1, usecols=x_cols, dtype=float)
     z = np.loadtxt(csv_path, delimiter=',', skiprows=1, usecols=z_cols, dtype=float)
@@ -259,6 +866,38 @@ def load_gmm_dataset(csv_path):
     return x, z
 
 
+def gmm_columns(headers):
+    """Return the indices of the feature columns and of the label column."""
+    x_cols = [i for i in range(len(headers)) if headers[i].startswith('x')]
+    z_cols = [i for i in range(len(headers)) if headers[i] == 'z']
+    return x_cols, z_cols
+
+
+def iter_gmm_dataset(csv_path, chunk_size=1024):
+    """Read a dataset in the format of load_gmm_dataset in chunks of rows.
+
+    Only one chunk is held in memory at a time.
+
+    Args:
+         csv_path: Path to CSV file containing dataset.
+         chunk_size: Number of rows per chunk.
+
+    Yields:
+        x: NumPy array shape (chunk_size, n), shorter for the last chunk
+        z: NumPy array shape (chunk_size, 1), shorter for the last chunk
+    """
+    with open(csv_path, 'r') as csv_fh:
+        headers = csv_fh.readline().strip().split(',')
+        x_cols, z_cols = gmm_columns(headers)
+        while True:
+            lines = list(itertools.islice(csv_fh, chunk_size))
+            if not lines:
+                return
+            x = np.loadtxt(lines, delimiter=',', usecols=x_cols, dtype=float, ndmin=2)
+            z = np.loadtxt(lines, delimiter=',', usecols=z_cols, dtype=float, ndmin=2)
+            yield x, z
+
+
 if __name__ == '__main__':
     np.random.seed(229)
     # Run NUM_TRIALS trials to see how different initializations
@@ -270,5 +909,5 @@ if __name__ == '__main__':
         # Once you've implemented the semi-supervised version,
         # uncomment the following line.
         # You do not need to add any other lines in this code block.
-        # main(with_supervision=True, trial_num=t)
+        main(is_semi_supervised=True, trial_num=t)
         # *** END CODE HERE ***
\ No newline at end of file
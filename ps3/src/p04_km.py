@@ -1,5 +1,6 @@
 from __future__ import division, print_function
 import argparse
+import collections
 import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
 import numpy as np
@@ -7,6 +8,10 @@ import os
 import random
 import sys
 
+# Color -> cluster lookup tables of recent centroids, see color_labels
+LUT_CACHE_SIZE = 2
+_lut_cache = collections.OrderedDict()
+
 
 def init_centroids(num_clusters, image):
     """
@@ -34,25 +39,15 @@ def init_centroids(num_clusters, image):
     idx = np.random.randint(0,W,num_clusters)
     idy = np.random.randint(0,H,num_clusters)
 
-    centroids_init = np.zeros(C,num_clusters)
-    for i in range(num_clusters):
-        centroids_init[:,i] = 
-
-
-    print(idx.shape)
-    print(idy.shape)
-
-    sys.exit(1)
-
-
-    # raise NotImplementedError('init_centroids function not implemented')
+    centroids_init = image[idy,idx].astype(float)
     # *** END YOUR CODE ***
     return centroids_init
 
 
-def update_centroids(centroids, image, max_iter=30, print_every=10):
+def update_centroids(centroids, image, max_iter=30, print_every=10, chunk_size=65536):
     """
-    Carry out k-means centroid update step `max_iter` times
+    Carry out k-means centroid update step up to `max_iter` times,
+    stopping early once no pixel changes cluster
 
     Parameters
     ----------
@@ -61,9 +56,11 @@ def update_centroids(centroids, image, max_iter=30, print_every=10):
     image : nparray
         (H, W, C) image represented as an nparray
     max_iter : int
-        Number of iterations to run
+        Maximum number of iterations to run
     print_every : int
         Frequency of status update
+    chunk_size : int
+        Number of pixels per distance computation
 
     Returns
     -------
@@ -71,11 +68,136 @@ def update_centroids(centroids, image, max_iter=30, print_every=10):
         Updated centroids
     """
     # *** START YOUR CODE ***
-    new_centroids = None
+    num_clusters, C = centroids.shape
+    pixels = image.reshape(-1, C).astype(float)
+    new_centroids = np.array(centroids, dtype=float)
+    labels = None
+
+    for it in range(max_iter):
+        new_labels = assign_clusters(pixels, new_centroids, chunk_size)
+        num_changed = len(new_labels) if labels is None else np.count_nonzero(new_labels != labels)
+        if num_changed == 0:
+            print('[INFO] Converged after {} iterations'.format(it))
+            break
+        labels = new_labels
+
+        # Per-cluster pixel counts and channel sums as bincount reductions
+        counts = np.bincount(labels, minlength=num_clusters)
+        sums = np.stack([np.bincount(labels, weights=pixels[:, c], minlength=num_clusters)
+                         for c in range(C)], axis=1)
+        # Empty clusters keep their centroid
+        nonempty = counts > 0
+        new_centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+
+        if (it + 1) % print_every == 0:
+            print('[INFO] Iteration {}: {} pixels changed cluster'.format(it + 1, num_changed))
     # *** END YOUR CODE ***
     return new_centroids
 
 
+def update_centroids_minibatch(centroids, image, batch_size=1024, max_iter=150, print_every=10, tol=2e-3,
+                               holdout_size=8192):
+    """
+    Carry out mini-batch k-means steps on random batches of pixels
+
+    Each step samples `batch_size` pixels and moves every centroid towards
+    the mean of its assigned pixels with learning rate (pixels assigned in
+    this batch) / (pixels assigned so far), i.e. a running mean per centroid.
+    Only the sampled pixels are read, so `image` may be a memory-mapped
+    array far larger than memory.
+
+    A single step's centroid shift is dominated by batch noise, so
+    convergence is instead checked every `print_every` steps on the mean
+    squared distance of a fixed held-out sample of pixels to their closest
+    centroid.
+
+    Parameters
+    ----------
+    centroids : nparray
+        The centroids stored as an nparray
+    image : nparray
+        (H, W, C) image represented as an nparray
+    batch_size : int
+        Number of pixels sampled per step
+    max_iter : int
+        Maximum number of steps to run
+    print_every : int
+        Frequency of status update and convergence check
+    tol : float
+        Stop once the held-out error improves by less than this fraction
+        over `print_every` steps
+    holdout_size : int
+        Number of pixels sampled to measure the held-out error
+
+    Returns
+    -------
+    new_centroids : nparray
+        Updated centroids
+    """
+    num_clusters, C = centroids.shape
+    pixels = image.reshape(-1, C)
+    new_centroids = np.array(centroids, dtype=float)
+    seen = np.zeros(num_clusters)
+    holdout = pixels[np.sort(np.random.randint(0, len(pixels), holdout_size))].astype(float)
+    prev_error = None
+
+    for it in range(max_iter):
+        # Sorted indices read a memory-mapped image front to back
+        batch = pixels[np.sort(np.random.randint(0, len(pixels), batch_size))].astype(float)
+        labels = assign_clusters(batch, new_centroids)
+
+        counts = np.bincount(labels, minlength=num_clusters)
+        sums = np.stack([np.bincount(labels, weights=batch[:, c], minlength=num_clusters)
+                         for c in range(C)], axis=1)
+        seen += counts
+        assigned = counts > 0
+        step = (sums[assigned] - counts[assigned, None] * new_centroids[assigned]) / seen[assigned, None]
+        new_centroids[assigned] += step
+
+        if (it + 1) % print_every == 0:
+            closest = new_centroids[assign_clusters(holdout, new_centroids)]
+            error = np.mean(np.sum((holdout - closest) ** 2, axis=1))
+            print('[INFO] Iteration {}: held-out error {:.4f}'.format(it + 1, error))
+            if prev_error is not None and prev_error - error < tol * prev_error:
+                print('[INFO] Converged after {} iterations'.format(it + 1))
+                break
+            prev_error = error
+
+    return new_centroids
+
+
+def assign_clusters(pixels, centroids, chunk_size=65536):
+    """
+    Find the index of the closest centroid for every pixel
+
+    Squared distances |x - c|^2 = |x|^2 + |c|^2 - 2 x.c are computed as one
+    matrix product per chunk of `chunk_size` pixels, so memory stays at
+    chunk_size x num_clusters. |x|^2 is the same for every centroid, so it is
+    left out of the argmin.
+
+    Parameters
+    ----------
+    pixels : nparray
+        (N, C) pixel values
+    centroids : nparray
+        (num_clusters, C) centroids
+    chunk_size : int
+        Number of pixels per distance computation
+
+    Returns
+    -------
+    labels : nparray
+        (N,) index of the closest centroid of each pixel
+    """
+    centroids = np.asarray(centroids, dtype=float)
+    sq_centroids = np.sum(centroids ** 2, axis=1)
+    labels = np.empty(len(pixels), dtype=np.intp)
+    for start in range(0, len(pixels), chunk_size):
+        chunk = pixels[start:start + chunk_size]
+        labels[start:start + chunk_size] = np.argmin(sq_centroids - 2 * chunk @ centroids.T, axis=1)
+    return labels
+
+
 def update_image(image, centroids):
     """
     Update RGB values of pixels in `image` by finding
@@ -95,17 +217,64 @@ def update_image(image, centroids):
     """
 
     # *** START YOUR CODE ***
-    new_image = None
-    
-    # raise NotImplementedError('update_image function not implemented')
-            # Initialize `dist` vector to keep track of distance to every centroid
-            # Loop over all centroids and store distances in `dist`
-            # Find closest centroid and update pixel value in `image`
+    H, W, C = image.shape
+    if image.dtype == np.uint8 and C == 3:
+        labels = color_labels(image.reshape(-1, C), centroids)
+    else:
+        labels = assign_clusters(image.reshape(-1, C).astype(float), centroids)
+    palette = np.asarray(centroids)
+    if np.issubdtype(image.dtype, np.integer):
+        palette = np.round(palette)
+    new_image = palette.astype(image.dtype)[labels].reshape(H, W, C)
     # *** END YOUR CODE ***
 
     return new_image
 
 
+def color_labels(pixels, centroids):
+    """
+    Find the closest centroid of 8-bit RGB pixels through a color lookup table
+
+    Each pixel is packed into a 24-bit key. The table maps keys to cluster
+    indices, with -1 for colors not seen yet. Only the distinct unseen colors
+    (from np.unique, whose inverse indices scatter the results back) go
+    through assign_clusters, so the cost scales with the number of distinct
+    colors rather than pixels. Tables of the last LUT_CACHE_SIZE centroid
+    sets are kept, so images sharing a palette reuse each other's work.
+
+    Parameters
+    ----------
+    pixels : nparray
+        (N, 3) uint8 pixel values
+    centroids : nparray
+        (num_clusters, 3) centroids
+
+    Returns
+    -------
+    labels : nparray
+        (N,) index of the closest centroid of each pixel
+    """
+    centroids = np.asarray(centroids, dtype=float)
+    cache_key = centroids.tobytes()
+    lut = _lut_cache.pop(cache_key, None)
+    if lut is None:
+        lut = np.full(1 << 24, -1, dtype=np.int16 if len(centroids) < 2 ** 15 else np.int32)
+        while len(_lut_cache) >= LUT_CACHE_SIZE:
+            _lut_cache.popitem(last=False)
+    _lut_cache[cache_key] = lut
+
+    keys = (pixels[:, 0].astype(np.int32) << 16) | (pixels[:, 1].astype(np.int32) << 8) | pixels[:, 2]
+    labels = lut[keys].astype(np.intp)
+    unseen = labels < 0
+    if np.any(unseen):
+        colors, inverse = np.unique(keys[unseen], return_inverse=True)
+        rgb = np.stack([colors >> 16, (colors >> 8) & 255, colors & 255], axis=1).astype(float)
+        color_clusters = assign_clusters(rgb, centroids)
+        lut[colors] = color_clusters
+        labels[unseen] = color_clusters[inverse]
+    return labels
+
+
 def main(args):
 
     # Setup
@@ -114,6 +283,7 @@ def main(args):
     image_path_small = args.small_path
     image_path_large = args.large_path
     num_clusters = args.num_clusters
+    batch_size = args.batch_size
     figure_idx = 0
 
     # Load small image
@@ -135,11 +305,15 @@ def main(args):
     print(25 * '=')
     print('Updating centroids ...')
     print(25 * '=')
-    centroids = update_centroids(centroids_init, image, max_iter, print_every)
+    if batch_size > 0:
+        # Mini-batch k-means fits directly on the large image
+        image_large = mpimg.imread(image_path_large)
+        centroids = update_centroids_minibatch(centroids_init, image_large, batch_size, max_iter, print_every)
+    else:
+        centroids = update_centroids(centroids_init, image, max_iter, print_every)
 
     # Load large image
-    image = mpimg.imread(image_path_large)
-    image.setflags(write=1)
+    image = np.copy(mpimg.imread(image_path_large))
     print('[INFO] Loaded large image with shape: {}'.format(np.shape(image)))
     plt.figure(figure_idx)
     figure_idx += 1
@@ -179,5 +353,8 @@ if __name__ == '__main__':
                         help='Number of centroids/clusters')
     parser.add_argument('--print_every', type=int, default=10,
                         help='Iteration print frequency')
+    parser.add_argument('--batch_size', type=int, default=0,
+                        help='Pixels per mini-batch k-means step on the large image '
+                             '(0 for full-batch k-means on the small image)')
     args = parser.parse_args()
     main(args)
\ No newline at end of file